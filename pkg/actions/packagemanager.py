@@ -3,10 +3,11 @@ import threading
 from __palette__ import Palette, show_palette, Action
 
 from . import register_action
+from ..catalog import get_catalog_packages
 from ..config import g, _save_config
 from ..logger import getLogger
 from ..package import LocalPackage
-from ..repo import get_online_packages, Repository
+from ..repo import find_package
 
 log = getLogger(__name__)
 
@@ -19,7 +20,8 @@ def _run_in_background(f):
 
 @register_action('Packages: Install Package')
 def install_package():
-    pkgs = get_online_packages()
+    # Served from the local catalog, which is refreshed in background
+    pkgs = get_catalog_packages()
     pkgs = [x for x in pkgs if LocalPackage.by_name(x.id) is None]
     actions = [
         (lambda _: Action(id=_.id, name=_.name, description=_.description,
@@ -50,13 +52,11 @@ def upgrade_package():
 
 def _upgrade_package(name):
     log.info("Upgrading package %s..." % name)
-    repos = [Repository.from_url(url) for url in g['repos']]
 
-    for repo in repos:
-        res = repo.get(name)
-        if res:
-            res.install(upgrade=True)
-            return
+    res = find_package(name, g['repos'])
+    if res:
+        res.install(upgrade=True)
+        return
 
     log.info(
         "Package not found on all repositories! Please check ~/idapkg/config.json")
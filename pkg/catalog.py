@@ -0,0 +1,155 @@
+"""
+Local catalog of packages in each repository, stored at :code:`cache/catalog.json`.
+
+The catalog answers immediately with the last known package lists, and is refreshed
+from the repositories in background (stale-while-revalidate). A repository which failed to answer
+before it was ever listed is recorded with no packages, and retried in background.
+"""
+
+import json
+import os
+import threading
+import time
+
+from .config import g
+from .http_cache import _write_atomic
+from .logger import getLogger
+from .package import InstallablePackage
+from .repo import Repository, iter_online_packages, TIMEOUT
+
+log = getLogger(__name__)
+
+_FIELDS = ('id', 'name', 'version', 'description', 'author')
+
+# Seconds before a repository which failed to answer is asked again
+FAILED_RETRY_INTERVAL = 60
+
+
+class Catalog(object):
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._repos = None
+        self._refreshing = None
+
+    @property
+    def path(self):
+        return self._path or os.path.join(g['path']['cache'], 'catalog.json')
+
+    def _load(self):
+        if self._repos is None:
+            try:
+                with open(self.path, 'rb') as f:
+                    self._repos = json.loads(f.read().decode('utf8'))
+            except (IOError, OSError, ValueError):
+                self._repos = {}
+        return self._repos
+
+    def packages(self, repos):
+        """
+        Packages of `repos` in the catalog.
+
+        :returns: (list of InstallablePackage, list of repo urls missing in the catalog)
+        """
+        with self._lock:
+            known = self._load()
+            entries = [(url, known.get(url)) for url in repos]
+
+        result = []
+        missing = []
+        for url, entry in entries:
+            if entry is None:
+                missing.append(url)
+                continue
+            repo = Repository.from_url(url)
+            result.extend(InstallablePackage(repo=repo, **item) for item in entry['packages'])
+        return result, missing
+
+    def stale(self, repos):
+        """
+        Repo urls of `repos` in the catalog to be refreshed. Failed ones wait for :code:`FAILED_RETRY_INTERVAL`.
+        """
+        now = time.time()
+        with self._lock:
+            known = self._load()
+            return [url for url in repos if url in known and
+                    now - known[url].get('failed_at', 0) > FAILED_RETRY_INTERVAL]
+
+    def _save(self):
+        try:
+            _write_atomic(self.path, json.dumps(self._repos).encode('utf8'))
+        except (IOError, OSError) as e:
+            log.debug('Failed to save catalog: %s', e)
+
+    def update(self, url, packages):
+        with self._lock:
+            self._load()[url] = {
+                'fetched_at': time.time(),
+                'packages': [dict((key, getattr(pkg, key)) for key in _FIELDS) for pkg in packages]
+            }
+            self._save()
+
+    def fail(self, url):
+        """
+        Records that `url` didn't answer. Last known packages of the repo are kept.
+        """
+        with self._lock:
+            entry = self._load().get(url)
+            if entry is not None and 'failed_at' not in entry:
+                return
+            self._repos[url] = {'failed_at': time.time(), 'packages': []}
+            self._save()
+
+    def refresh(self, repos, deadline=None):
+        """
+        Fetches package lists of `repos`, and updates the catalog for each repo as soon as it answers.
+        See :func:`~pkg.repo.iter_online_packages` for `deadline`.
+        """
+        pending = set(repos)
+        for repo, packages in iter_online_packages(repos, deadline):
+            pending.discard(repo.url)
+            self.update(repo.url, packages)
+
+        for url in pending:
+            self.fail(url)
+
+    def refresh_in_background(self, repos):
+        """
+        Starts :meth:`refresh` in a thread, unless one is already running.
+        """
+        with self._lock:
+            if self._refreshing is not None and self._refreshing.is_alive():
+                return self._refreshing
+            self._refreshing = threading.Thread(target=self.refresh, args=(list(repos),))
+            self._refreshing.daemon = True
+            self._refreshing.start()
+            return self._refreshing
+
+
+CATALOG = Catalog()
+
+
+def get_catalog_packages(repos=None):
+    """
+    Like :func:`~pkg.repo.get_online_packages`, but answers from the local catalog and refreshes it
+    in background. Repositories not in the catalog yet are fetched before returning, waiting
+    at most :code:`TIMEOUT` seconds for them. Those failing are retried in background afterwards.
+
+    :param repos: Array of repository urls (string). Default: g['repos']
+    :type repos: list(str) or None
+    :returns: list(:class:`~pkg.package.InstallablePackage`) from each repos.
+    """
+    if repos is None:
+        repos = g['repos']
+
+    packages, missing = CATALOG.packages(repos)
+    if missing:
+        CATALOG.refresh(missing, TIMEOUT)
+        packages, _ = CATALOG.packages(repos)
+
+    fresh = set(missing)
+    stale = [url for url in CATALOG.stale(repos) if url not in fresh]
+    if stale:
+        CATALOG.refresh_in_background(stale)
+
+    return packages
@@ -4,12 +4,13 @@ Some console-friendly methods are exposed in pkg.*, and defined at pkg.commands.
 import re
 import threading
 
+from .lockfile import install_locked as _install_locked
 from .config import g
 from .package import LocalPackage
-from .repo import Repository
+from .repo import find_package
 from .vendor import semantic_version
 
-__all__ = ['install', 'remove', 'local', 'remote', 'refresh', 'upgrade']
+__all__ = ['install', 'install_locked', 'remove', 'local', 'remote', 'refresh', 'upgrade']
 
 
 def _parse_spec(spec):
@@ -24,7 +25,7 @@ def _parse_spec(spec):
     return name, version
 
 
-def install(spec, repo=None, upgrade=False):
+def install(spec, repo=None, upgrade=False, lockfile=None):
     """
     Download and install a package from specified repository.
     See :meth:`install_from_repo`.
@@ -34,6 +35,7 @@ def install(spec, repo=None, upgrade=False):
     :param repo: URL of the repository. Default: :code:`g['repos']`
     :type repo: list(str) or None
     :param upgrade: Upgrade when already installed if True.
+    :param lockfile: Path to write a lockfile pinning the installed packages. See :meth:`install_locked`.
     """
 
     name, version = _parse_spec(spec)
@@ -43,7 +45,7 @@ def install(spec, repo=None, upgrade=False):
         if pkg is None:
             raise Exception('Package not found in all repositories: %r' % name)
 
-        pkg.install(upgrade)
+        pkg.install(upgrade, lockfile)
 
     if repo is None:
         repo = g['repos']
@@ -53,6 +55,18 @@ def install(spec, repo=None, upgrade=False):
     return t
 
 
+def install_locked(path):
+    """
+    Install exact versions pinned by a lockfile, without resolving them again.
+    Archives are verified with their pinned sha256. See :mod:`pkg.lockfile`.
+
+    :param path: Path of a lockfile written by :code:`pkg.install(spec, lockfile=path)`.
+    """
+    t = threading.Thread(target=_install_locked, args=(path,))
+    t.start()
+    return t
+
+
 def remove(name):
     """
     Remove a package locally (LocalPackage.remove).
@@ -72,26 +86,19 @@ def local(name):
     return LocalPackage.by_name(name)
 
 
-def remote(name, repo=None):
+def remote(name, repo=None, mode='priority'):
     """
-    Find a remote package from given repos.
+    Find a remote package from given repos. All repos are asked at once.
 
     :param name: Name of the package
     :param repo: URL of the repository. Default: :code:`g['repos']`
     :type repo: list(str) or None
+    :param mode: :code:`'priority'` (earliest repo in the list), :code:`'first'` (fastest repo)
+      or :code:`'version'` (highest version). See :func:`~pkg.repo.find_package`.
     :returns: None if package is not found, else InstallablePackage instance.
     :rtype: InstallablePackage
     """
-    if repo is None:
-        repo = g['repos']
-
-    for _repo in repo:
-        pkg = Repository.from_url(_repo).get(name)
-        if pkg is None:
-            continue
-        else:
-            return pkg
-    return None
+    return find_package(name, repo, mode)
 
 
 def refresh():
@@ -104,12 +111,13 @@ def refresh():
     return True
 
 
-def upgrade(spec, repo=None):
+def upgrade(spec, repo=None, lockfile=None):
     """
     Upgrade specified package. (:code:`pkg.install(spec, repo, upgrade=True)`)
 
     :param spec: `name==version`, or just `name` only.
     :param repo: target repository to download.
     :type spec: str
+    :param lockfile: Path to write a lockfile pinning the installed packages.
     """
-    return install(spec, repo, upgrade=True)
+    return install(spec, repo, upgrade=True, lockfile=lockfile)
@@ -1,20 +1,30 @@
+import os
 import sys
 
 if sys.version_info.major == 3:
     from http.client import (
-        HTTPSConnection, HTTPConnection, CannotSendRequest, ResponseNotReady, RemoteDisconnected)
+        HTTPSConnection, HTTPConnection, CannotSendRequest, ResponseNotReady, RemoteDisconnected, IncompleteRead)
     from urllib.parse import urlparse, urljoin, quote
 
     basestring = str
+    replace = os.replace
 else:
     from urllib import quote
     from urlparse import urlparse, urljoin
     from httplib import (
-        HTTPSConnection, HTTPConnection, CannotSendRequest, ResponseNotReady, BadStatusLine as RemoteDisconnected)
+        HTTPSConnection, HTTPConnection, CannotSendRequest, ResponseNotReady, BadStatusLine as RemoteDisconnected,
+        IncompleteRead)
 
     basestring = basestring
 
+    def replace(src, dst):
+        # os.rename does not overwrite on windows
+        if sys.platform == 'win32' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
 __all__ = (
     'quote', 'urlparse',
     'HTTPSConnection', 'HTTPConnection', 'CannotSendRequest', 'ResponseNotReady', 'RemoteDisconnected',
-    'basestring')
+    'IncompleteRead',
+    'basestring', 'replace')
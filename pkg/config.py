@@ -7,12 +7,25 @@ This module generates and manages config data. Initial config is like this:
     __initial_config = {
         'path': {
             'virtualenv': idapkg_dir('python'),
-            'packages': idapkg_dir('packages')
+            'packages': idapkg_dir('packages'),
+            'cache': idapkg_dir('cache'),
+            'archives': idapkg_dir('archives'),
+            'store': idapkg_dir('store')
         },
         'repos': [
             'https://api.idapkg.com'
         ],
-        'idausr_native_bases': [None, None]
+        'idausr_native_bases': [None, None],
+        'http_cache': {
+            'max_age': 0
+        },
+        'archive_store': {
+            'max_size': 1024 * 1024 * 1024
+        },
+        'file_store': {
+            'enabled': True,
+            'hardlink': False
+        }
     }
 
 :g:
@@ -20,6 +33,20 @@ This module generates and manages config data. Initial config is like this:
     Loaded from and saved to ~/idapkg/config.json.
     :code:`g['path']['packages'] == idapkg_dir('python')` initially.
 
+:g['http_cache']['max_age']:
+    Seconds a cached repository response is used without asking the server again.
+    0 means every response is revalidated (ETag / Last-Modified).
+
+:g['archive_store']['max_size']:
+    Total size in bytes of release archives kept at :code:`g['path']['archives']`.
+    Least recently used archives are removed first.
+
+:g['file_store']:
+    Files of installed packages are reflinks to :code:`g['path']['store']`, so identical files
+    are stored once. Where reflinks are not supported, packages are extracted as plain files.
+    Set :code:`hardlink` to True to use hard links there instead, which share writes to a file
+    with every package linked to it, or :code:`enabled` to False to always extract plain files.
+
 """
 from __future__ import print_function
 
@@ -93,7 +120,10 @@ def _fix_missing_config(obj, reference, path=None):
 __initial_config = {
     'path': {
         'virtualenv': _idapkg_dir('python'),
-        'packages': _idapkg_dir('packages')
+        'packages': _idapkg_dir('packages'),
+        'cache': _idapkg_dir('cache'),
+        'archives': _idapkg_dir('archives'),
+        'store': _idapkg_dir('store')
     },
     'repos': [
         'https://api.idapkg.com'
@@ -103,7 +133,17 @@ __initial_config = {
             version_info.str(): [None, None]
         }
     },
-    'ignored_packages': []
+    'ignored_packages': [],
+    'http_cache': {
+        'max_age': 0
+    },
+    'archive_store': {
+        'max_size': 1024 * 1024 * 1024
+    },
+    'file_store': {
+        'enabled': True,
+        'hardlink': False
+    }
 }
 
 # Step 1. create configuration
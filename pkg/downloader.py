@@ -3,12 +3,28 @@ HTTP downloader as minimal as possible.
 I'm not sure if its codebase is minimal enough.
 """
 
+import email.utils
+import hashlib
+import io
+import json
+import mmap
+import os
+import random
+import select
 import shutil
-import tempfile
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from .compat import (
     HTTPSConnection, HTTPConnection, urlparse, urljoin,
-    CannotSendRequest, ResponseNotReady, RemoteDisconnected)
+    CannotSendRequest, ResponseNotReady, RemoteDisconnected, IncompleteRead, basestring, replace)
+from .config import g
+from .http_cache import HTTP_CACHE, REDIRECTS
+from .logger import getLogger
+
+log = getLogger(__name__)
 
 # Supported protocols
 SCHEME_MAP = {
@@ -16,70 +32,946 @@ SCHEME_MAP = {
     'http': HTTPConnection
 }
 
-# Default value of max retry count for one fetch
+# Default value of max retry count for one request
 RETRY_COUNT = 3
 
+# A host is not asked again for BREAKER_COOLDOWN seconds after BREAKER_THRESHOLD failures in a row
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+# Max count of redirects followed by one fetch
+MAX_REDIRECTS = 10
+
+# Max idle keep-alive connections kept per (scheme, netloc)
+POOL_MAX_IDLE = 4
+
+# Idle keep-alive connections older than this (in seconds) are closed instead of reused
+POOL_IDLE_TIMEOUT = 30
+
+# Max count of resumptions (Range requests) for one file download
+RESUME_COUNT = 5
+
+# Partial downloads older than this (in seconds) are not resumed and get cleaned up
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+
+# Buffer size for copying response bodies
+CHUNK_SIZE = 64 * 1024
+
+# Files up to this size (in bytes) are kept in memory instead of a spool file
+MEMORY_SPOOL_SIZE = 1024 * 1024
+
+# Segmented downloads: files larger than this (in bytes) are fetched as parallel byte ranges
+SEGMENT_THRESHOLD = 8 * 1024 * 1024
+
+# Segmented downloads: count of ranges fetched at the same time
+SEGMENT_COUNT = 4
+
+
+def _is_alive(conn):
+    """
+    Health check for an idle connection. A connection which was never connected is fine,
+    since it connects on the next request. An idle socket must not be readable: that means
+    either the server closed it (EOF) or sent something we did not ask for.
+    """
+    sock = conn.sock
+    if sock is None:
+        return True
+
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError, select.error):
+        return False
+    return not readable
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive connections.
+
+    A connection is owned by exactly one request at a time: it is checked out before sending
+    a request, and checked back in after its response is fully read.
+    At most :code:`max_idle` idle connections are kept per host.
+    """
+
+    def __init__(self, max_idle=POOL_MAX_IDLE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def checkout(self, scheme, netloc, timeout=None):
+        key = (scheme, netloc)
+        now = time.time()
+        expired = []
+
+        with self._lock:
+            idle = self._idle.get(key, [])
+            conn = None
+            while idle:
+                candidate, since = idle.pop()
+                if now - since <= self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+
+        for candidate in expired:
+            candidate.close()
+
+        if conn is not None:
+            if _is_alive(conn):
+                if timeout is not None:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                return conn
+            conn.close()
+
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return SCHEME_MAP[scheme](netloc, **kwargs)
+
+    def checkin(self, scheme, netloc, conn):
+        key = (scheme, netloc)
+        now = time.time()
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            expired = [item for item in idle if now - item[1] > self.idle_timeout]
+            idle[:] = [item for item in idle if now - item[1] <= self.idle_timeout]
+            if len(idle) < self.max_idle:
+                idle.append((conn, now))
+            else:
+                expired.append((conn, now))
+
+        for candidate, _ in expired:
+            candidate.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+
 # Keep-alive connections
-CACHED_CONNECTIONS = {}
+POOL = ConnectionPool()
+
+
+class PooledResponse(object):
+    """
+    Wraps a response from a pooled connection.
+    The connection goes back to the pool when the body is fully read,
+    and is discarded when the response is closed before that.
+    :code:`url` is the final url after redirects.
+    """
+
+    def __init__(self, url, scheme, netloc, conn, res):
+        self.url = url
+        self._key = scheme, netloc
+        self._conn = conn
+        self._res = res
+
+    def read(self, amt=None):
+        data = self._res.read() if amt is None else self._res.read(amt)
+        self._release_if_done()
+        return data
+
+    def readinto(self, buf):
+        size = self._res.readinto(buf)
+        self._release_if_done()
+        return size
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            conn.close()
+        self._res.close()
+
+    def _release_if_done(self):
+        if self._conn is None or not self._res.isclosed():
+            return
+
+        conn, self._conn = self._conn, None
+        # A body shorter than Content-Length means the connection was dropped
+        if self._res.will_close or self._res.length:
+            conn.close()
+        else:
+            POOL.checkin(self._key[0], self._key[1], conn)
+
+    def __getattr__(self, name):
+        return getattr(self._res, name)
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a failed request is sent again:
+    exponential backoff with jitter, and :code:`Retry-After` for 429 / 5xx answers.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=RETRY_COUNT, backoff=0.5, max_delay=30, jitter=0.5):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt, res=None):
+        """
+        Seconds to wait before retry number `attempt` (from 0), or None if it should not be retried.
+        """
+        if attempt >= self.retries:
+            return None
+
+        if res is not None:
+            if res.status not in self.RETRY_STATUSES:
+                return None
+            retry_after = _retry_after(res)
+            if retry_after is not None:
+                return retry_after if retry_after <= self.max_delay else None
+
+        delay = min(self.max_delay, self.backoff * 2 ** attempt)
+        return delay * (1 + self.jitter * random.random())
+
+
+def _retry_after(res):
+    value = res.getheader('Retry-After', None)
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
 
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
 
-def _fetch(orig_url, timeout, retry=RETRY_COUNT):
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker. After :code:`threshold` failures in a row, requests to the host fail
+    immediately for :code:`cooldown` seconds. Then one more try is let through.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def check(self, host):
+        now = time.time()
+        with self._lock:
+            failures, opened_at = self._hosts.get(host, (0, None))
+            if opened_at is None:
+                return
+            if now - opened_at >= self.cooldown:
+                # Let this request try, while others keep failing fast until it's done
+                self._hosts[host] = failures, now
+                return
+
+        raise Exception("%s is unreachable; not retrying for %d seconds" % (
+            host, self.cooldown - (now - opened_at)))
+
+    def success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host):
+        with self._lock:
+            failures, opened_at = self._hosts.get(host, (0, None))
+            failures += 1
+            if failures >= self.threshold:
+                opened_at = time.time()
+            self._hosts[host] = failures, opened_at
+
+
+RETRY_POLICY = RetryPolicy()
+BREAKER = CircuitBreaker()
+
+
+def _request(orig_url, timeout, headers=None, policy=None):
+    """
+    Sends a single GET request over a pooled connection, retrying as `policy` says.
+    """
     url = urlparse(orig_url)
-    cls = SCHEME_MAP[url.scheme]
+    policy = policy or RETRY_POLICY
+
+    request_headers = {'Connection': 'Keep-Alive'}
+    request_headers.update(headers or {})
+
+    attempt = 0
+    while True:
+        BREAKER.check(url.netloc)
 
-    if not retry:
-        raise Exception("Max retries exceeded.")
+        conn = POOL.checkout(url.scheme, url.netloc, timeout)
+        reused = conn.sock is not None
+        try:
+            conn.request(
+                "GET",
+                ''.join((url.path or '/', '?' + url.query if url.query else '')),
+                headers=request_headers)
+            res = conn.getresponse()
+        except (CannotSendRequest, ResponseNotReady, RemoteDisconnected, IOError, OSError) as e:
+            conn.close()
+            if reused:
+                # Keep-alive expired; try again with another connection
+                continue
 
-    kwargs = {}
-    if timeout is not None:
-        kwargs['timeout'] = timeout
+            BREAKER.failure(url.netloc)
+            delay = policy.delay(attempt)
+            if delay is None:
+                raise Exception("Max retries exceeded: %s (from %s)" % (e, orig_url))
+        else:
+            res = PooledResponse(orig_url, url.scheme, url.netloc, conn, res)
+            if res.status // 100 == 5:
+                BREAKER.failure(url.netloc)
+            else:
+                BREAKER.success(url.netloc)
 
-    key = (url.scheme, url.netloc)
-    if key in CACHED_CONNECTIONS:
-        conn = CACHED_CONNECTIONS[key]
+            delay = policy.delay(attempt, res)
+            if delay is None:
+                return res
+
+            # Drain the body so the connection can be reused
+            res.read()
+
+        log.debug('Retrying %r in %.1f seconds...', orig_url, delay)
+        time.sleep(delay)
+        attempt += 1
+
+
+def _fetch(orig_url, timeout, headers=None, accept=()):
+    """
+    GET `orig_url`, following redirects up to :code:`MAX_REDIRECTS` hops.
+    Permanent redirects (301, 308) are remembered, so later requests go to the target directly.
+
+    :param accept: Error statuses returned as a response instead of raised.
+    """
+    url = REDIRECTS.resolve(orig_url)
+
+    for _ in range(MAX_REDIRECTS + 1):
+        res = _request(url, timeout, headers)
+        loc = res.getheader("Location", None)
+
+        if not (res.status // 100 == 3 and loc):
+            break
+
+        # Drain the body so the connection can be reused
+        res.read()
+        new_url = urljoin(url, loc)
+        if res.status in (301, 308):
+            REDIRECTS.remember(url, new_url)
+        url = new_url
     else:
-        conn = cls(url.netloc, **kwargs)
-        CACHED_CONNECTIONS[key] = conn
+        raise Exception("Too many redirects (from %s)" % orig_url)
+
+    # 304 is only sent as an answer to a conditional request
+    if res.status // 100 != 2 and res.status != 304 and res.status not in accept:
+        res.close()
+        if REDIRECTS.forget(orig_url):
+            # The remembered target is gone; ask the original url again
+            return _fetch(orig_url, timeout, headers, accept)
+        raise Exception("HTTP status code: %d %s (from %s)" % (res.status, res.reason, orig_url))
+
+    return res
+
+
+def _download_cached(url, timeout):
+    meta = HTTP_CACHE.lookup(url)
+    if meta is not None and HTTP_CACHE.is_fresh(meta):
+        return HTTP_CACHE.read(url)
+
+    headers = HTTP_CACHE.conditional_headers(meta) if meta else None
+    res = _fetch(url, timeout, headers=headers)
+
+    if res.status == 304:
+        res.read()
+        HTTP_CACHE.touch(url, meta)
+        return HTTP_CACHE.read(url)
+
+    body = res.read()
+    HTTP_CACHE.store(url, res, body)
+    return body
+
+
+def _partial_dir():
+    path = os.path.join(g['path']['cache'], 'partial')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def _partial_path(url):
+    return os.path.join(_partial_dir(), hashlib.sha256(url.encode('utf8')).hexdigest() + '.part')
+
+
+def _cleanup_partials():
+    path = _partial_dir()
+    now = time.time()
+    for name in os.listdir(path):
+        name = os.path.join(path, name)
+        try:
+            if now - os.path.getmtime(name) > PARTIAL_MAX_AGE:
+                os.unlink(name)
+        except OSError:
+            pass
+
+
+def _load_partial_state(path, url):
+    """
+    Returns (offset, validator) of a partial download which can be resumed.
+    """
     try:
-        conn.request(
-            "GET",
-            ''.join((url.path or '/', '?' + url.query if url.query else '')),
-            headers={'Connection': 'Keep-Alive'})
-    except (CannotSendRequest, OSError):  # Keep-alive expired
-        del CACHED_CONNECTIONS[key]
-        return _fetch(orig_url, timeout, retry)
+        with open(path + '.json', 'rb') as f:
+            state = json.loads(f.read().decode('utf8'))
+        size = os.path.getsize(path)
+    except (IOError, OSError, ValueError):
+        return 0, None
+
+    if state.get('url') != url or not state.get('validator') or \
+            time.time() - os.path.getmtime(path) > PARTIAL_MAX_AGE:
+        return 0, None
+    return size, state['validator']
+
+
+def _save_partial_state(path, url, validator):
+    with open(path + '.json', 'wb') as f:
+        f.write(json.dumps({'url': url, 'validator': validator}).encode('utf8'))
+
+
+def _remove_partial_state(path):
     try:
-        res = conn.getresponse()
-    except (ResponseNotReady, RemoteDisconnected):
-        # RemoteDisconnected is also triggered when keep-alive is disconnected
-        # However it's safe to decrement retry count
-        return _fetch(orig_url, timeout, retry - 1)
+        os.unlink(path + '.json')
+    except OSError:
+        pass
 
-    loc = res.getheader("Location", None)
-    if res.getheader("Connection", "").lower() == "close":
-        del CACHED_CONNECTIONS[key]
 
-    if res.status // 100 == 3 and loc:
-        new_url = urljoin(orig_url, loc)
-        return _fetch(new_url, timeout)
+def _hash_file(path, digest, start=0, end=None):
+    """
+    Feeds bytes [start, end) of the file at `path` into `digest`.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start if end is not None else None
+        while remaining is None or remaining > 0:
+            chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest
 
-    if res.status // 100 != 2:
-        raise Exception("HTTP status code: %d %s (from %s)" % (res.status, res.reason, orig_url))
 
-    return res
+def _range_start(res):
+    # Content-Range: bytes START-END/TOTAL
+    try:
+        return int(res.getheader('Content-Range', '').split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _range_total(res):
+    try:
+        return int(res.getheader('Content-Range', '').split('/')[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _validator(res):
+    # Weak ETags can't be used with If-Range
+    etag = res.getheader('ETag', None)
+    if etag and not etag.startswith('W/'):
+        return etag
+    return res.getheader('Last-Modified', None)
+
+
+def _download_to_path(url, path, timeout=None, res=None):
+    """
+    Downloads `url` into `path`, which is kept while the download is incomplete.
+    When the connection drops, or a previous download of the same url was interrupted,
+    the rest is requested with :code:`Range: bytes=N-` and validated with :code:`If-Range`.
+
+    :param res: Already received non-ranged response of `url` to start with.
+    :returns: sha256 hex digest of the file, computed while writing it.
+    """
+    offset, validator = (0, None) if res else _load_partial_state(path, url)
+    resumes = RESUME_COUNT
+
+    digest = hashlib.sha256()
+    if offset:
+        _hash_file(path, digest, 0, offset)
+
+    while True:
+        headers = {}
+        if offset and validator:
+            headers = {'Range': 'bytes=%d-' % offset, 'If-Range': validator}
+
+        if res is None:
+            res = _fetch(url, timeout, headers=headers, accept=(416,) if headers else ())
+
+        if res.status == 416:
+            # Range Not Satisfiable: the partial file may already hold the whole body
+            res.read()
+            total = _range_total(res)
+            res = None
+            if total == offset:
+                log.debug('Partial download of %r is already complete (%d bytes)', url, offset)
+                break
+
+            log.debug('Cannot resume download of %r at %d bytes, starting over', url, offset)
+            _remove_partial_state(path)
+            offset, validator = 0, None
+            continue
+        elif res.status == 206 and _range_start(res) == offset:
+            log.debug('Resuming download of %r at %d bytes', url, offset)
+            mode = 'ab'
+        elif res.status == 206:
+            # Unexpected range; start over without it
+            res.close()
+            res = None
+            offset, validator = 0, None
+            continue
+        else:
+            offset = 0
+            mode = 'wb'
+            digest = hashlib.sha256()
+
+        validator = _validator(res)
+        if validator:
+            _save_partial_state(path, url, validator)
+
+        expected = res.length
+        received = 0
+        try:
+            with open(path, mode) as out_file:
+                while True:
+                    chunk = res.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out_file.write(chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+        except (IncompleteRead, IOError, OSError) as e:
+            res.close()
+            error = e
+        else:
+            error = None if expected is None or received >= expected else \
+                IncompleteRead(b'', expected - received)
+
+        offset += received
+        res = None
+        if error is None:
+            break
+
+        resumes -= 1
+        if not resumes or not validator:
+            raise Exception("Download interrupted: %s (from %s)" % (error, url))
+        log.info('Connection dropped while downloading %r, resuming at %d bytes...', url, offset)
+
+    _remove_partial_state(path)
+    return digest.hexdigest()
+
+
+def _positional_writer(f):
+    """
+    Returns write(data, position) for `f`, which is safe to call from several threads.
+    """
+    if hasattr(os, 'pwrite'):
+        fd = f.fileno()
+
+        def write(data, position):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, position)
+                view = view[written:]
+                position += written
+    else:
+        lock = threading.Lock()
+
+        def write(data, position):
+            with lock:
+                f.seek(position)
+                f.write(data)
+
+    return write
+
+
+def _fetch_range(url, timeout, write, start, end, validator, res=None, digest=None):
+    """
+    Fetches bytes [start, end] of `url` and writes them at the same position.
+    A dropped connection is resumed from the last received byte.
+    Bytes are fed into `digest` in order, if given.
+    """
+    position = start
+    resumes = RESUME_COUNT
+
+    while position <= end:
+        if res is None:
+            headers = {'Range': 'bytes=%d-%d' % (position, end)}
+            if validator:
+                headers['If-Range'] = validator
+            res = _fetch(url, timeout, headers=headers)
+        if res.status != 206 or _range_start(res) != position:
+            res.close()
+            raise Exception("Server ignored the range request (from %s)" % url)
+
+        try:
+            while position <= end:
+                chunk = res.read(min(CHUNK_SIZE, end - position + 1))
+                if not chunk:
+                    break
+                write(chunk, position)
+                if digest is not None:
+                    digest.update(chunk)
+                position += len(chunk)
+        except (IncompleteRead, IOError, OSError) as e:
+            res.close()
+            error = e
+        else:
+            error = 'connection closed'
+
+        res = None
+        if position <= end:
+            resumes -= 1
+            if not resumes:
+                raise Exception("Download interrupted: %s (from %s)" % (error, url))
+
+
+def _first_range_headers():
+    return {'Range': 'bytes=0-%d' % (SEGMENT_THRESHOLD - 1)}
+
+
+def _split_range(start, end, count):
+    size = end - start + 1
+    bounds = [start + size * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(count) if bounds[i] < bounds[i + 1]]
+
+
+def _download_segmented(url, path, timeout=None, res=None):
+    """
+    Like :func:`_download_to_path`, but a file larger than :code:`SEGMENT_THRESHOLD` is fetched as
+    :code:`SEGMENT_COUNT` byte ranges at once, over pooled connections.
+
+    The first ranged GET tells the length. When the server doesn't support ranges, or the file is
+    small, that response is used as a normal download.
+
+    :param res: Already received response of the first ranged GET.
+    :returns: sha256 hex digest of the file. The first range is hashed while it's written,
+      and the rest is read back once all ranges are done.
+    """
+    if res is None:
+        offset, _ = _load_partial_state(path, url)
+        if offset:
+            return _download_to_path(url, path, timeout)
+
+        res = _fetch(url, timeout, headers=_first_range_headers())
+
+    if res.status != 206:
+        return _download_to_path(url, path, timeout, res)
+
+    total = _range_total(res)
+    validator = _validator(res)
+
+    if _range_start(res) != 0 or total is None:
+        res.close()
+        return _download_to_path(url, path, timeout)
+    elif total <= SEGMENT_THRESHOLD:
+        segments = [(0, total - 1, res)]
+    elif not validator:
+        # Ranges can't be checked to come from the same file
+        res.close()
+        return _download_to_path(url, path, timeout)
+    else:
+        log.debug('Downloading %r in %d segments (%d bytes)', url, SEGMENT_COUNT, total)
+        segments = [(0, SEGMENT_THRESHOLD - 1, res)] + [
+            (start, end, None) for start, end in _split_range(SEGMENT_THRESHOLD, total - 1, SEGMENT_COUNT - 1)]
+
+    # Redirects are resolved by the first request
+    final_url = res.url
+    digest = hashlib.sha256()
+
+    with open(path, 'wb') as out_file:
+        # Preallocate the file, then every segment writes into its own position
+        out_file.truncate(total)
+        write = _positional_writer(out_file)
+
+        pool = ThreadPool(len(segments))
+        try:
+            pool.map(lambda segment: _fetch_range(final_url, timeout, write, segment[0], segment[1], validator,
+                                                  segment[2], digest if segment[0] == 0 else None),
+                     segments)
+        except Exception:
+            out_file.close()
+            os.unlink(path)
+            raise
+        finally:
+            pool.close()
+
+    first_end = segments[0][1] + 1
+    if first_end < total:
+        _hash_file(path, digest, first_end)
+    return digest.hexdigest()
+
+
+def _open_temporary(path, count=1):
+    """
+    Opens a completed download `count` times. The file is removed when all of them are closed.
+
+    :rtype: list
+    """
+    if sys.platform == 'win32':
+        flags = os.O_RDONLY | os.O_BINARY | os.O_TEMPORARY
+        return [os.fdopen(os.open(path, flags), 'rb') for _ in range(count)]
+
+    files = [open(path, 'rb') for _ in range(count)]
+    os.unlink(path)
+    return files
 
 
-def download(url, timeout=None, to_file=False):
-    res = _fetch(url, timeout)
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.results = None
+        self.error = None
 
+
+class SingleFlight(object):
+    """
+    Coalesces identical calls running at the same time.
+    The first caller of a key runs the function, and callers arriving while it runs wait
+    for it and share its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func, split=None):
+        """
+        :param split: split(result, count) returns a list of `count` results, one per caller,
+          for results which can't be shared as-is (e.g. file objects).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                index = None
+            else:
+                index = flight.followers
+                flight.followers += 1
+
+        if index is not None:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.results[index]
+
+        try:
+            result = func()
+        except Exception as e:
+            with self._lock:
+                del self._flights[key]
+            flight.error = e
+            flight.done.set()
+            raise
+
+        # No more followers after this
+        with self._lock:
+            del self._flights[key]
+            count = flight.followers + 1
+
+        try:
+            flight.results = split(result, count) if split else [result] * count
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            flight.done.set()
+        return flight.results[-1]
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+# One download per spool file at once
+_PARTIAL_LOCKS = {}
+_PARTIAL_LOCKS_LOCK = threading.Lock()
+
+
+def _partial_lock(path):
+    with _PARTIAL_LOCKS_LOCK:
+        if not _PARTIAL_LOCKS:
+            _cleanup_partials()
+        return _PARTIAL_LOCKS.setdefault(path, threading.Lock())
+
+
+def _whole_body_size(res):
+    """
+    Size of the whole file when `res` carries all of it, else None.
+    """
+    if res.status == 200:
+        return res.length
+    if res.status == 206 and _range_start(res) == 0 and _range_total(res) == res.length:
+        return res.length
+    return None
+
+
+def _check_digest(url, digest, sha256):
+    if sha256 is not None and digest != sha256.lower():
+        raise Exception("sha256 mismatch: expected %s, got %s (from %s)" % (sha256, digest, url))
+
+
+def _download_spooled(url, timeout, segmented, sha256=None, dest=None, memory_limit=0):
+    """
+    :param dest: Where to move the completed file. Default: a new file next to the spool file.
+    :param memory_limit: A body up to this size is returned as bytes instead, without touching disk.
+    :returns: (dest, sha256 hex digest, None), or (None, sha256 hex digest, body) for in-memory bodies
+    """
+    path = _partial_path(url)
+    if dest is None:
+        dest = '%s-%x.done' % (path, random.getrandbits(64))
+
+    with _partial_lock(path):
+        res = None
+        if memory_limit and not _load_partial_state(path, url)[0]:
+            res = _fetch(url, timeout, headers=_first_range_headers() if segmented else None)
+            size = _whole_body_size(res)
+            if size is not None and size <= memory_limit:
+                body = res.read()
+                res = None
+                if len(body) == size:
+                    digest = hashlib.sha256(body).hexdigest()
+                    _check_digest(url, digest, sha256)
+                    return None, digest, body
+
+        if segmented:
+            digest = _download_segmented(url, path, timeout, res)
+        else:
+            digest = _download_to_path(url, path, timeout, res)
+
+        try:
+            _check_digest(url, digest, sha256)
+        except Exception:
+            os.unlink(path)
+            _remove_partial_state(path)
+            raise
+
+        try:
+            replace(path, dest)
+        except OSError:
+            # Another filesystem
+            shutil.move(path, dest)
+        return dest, digest, None
+
+
+class MappedFile(object):
+    """
+    Read-only file object over an mmap of a file. Enough for :code:`zipfile.ZipFile`,
+    which then reads members straight from the page cache.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.name = getattr(f, 'name', None)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._map) - self._map.tell()
+        return self._map.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_mapped(path_or_file):
+    """
+    Opens a file as :class:`MappedFile`. Empty files, which can't be mapped, are returned as-is.
+    """
+    f = open(path_or_file, 'rb') if isinstance(path_or_file, basestring) else path_or_file
+    if os.fstat(f.fileno()).st_size == 0:
+        return f
+    return MappedFile(f)
+
+
+def _open_sink(result, count=1):
+    """
+    One file object per caller over a result of :func:`_download_spooled`: in-memory bytes,
+    or a spool file which is removed when all of them are closed.
+    """
+    path, _, body = result
+    if path is None:
+        return [io.BytesIO(body) for _ in range(count)]
+    return [open_mapped(f) for f in _open_temporary(path, count)]
+
+
+def download_file(url, dest, timeout=None, segmented=False, sha256=None):
+    """
+    Downloads `url` into the path `dest`. The file appears at `dest` only when it's complete.
+    See :func:`download` for `segmented` and `sha256`.
+
+    :returns: sha256 hex digest of the file
+    """
+    return _download_spooled(url, timeout, segmented, sha256, dest)[1]
+
+
+def download(url, timeout=None, to_file=False, cache=False, segmented=False, sha256=None):
+    """
+    Fetches `url` with GET.
+
+    :param to_file: Returns a seekable temporary file instead of the response.
+      Interrupted downloads are resumed, see :func:`_download_to_path`.
+    :param segmented: Large files are fetched as parallel byte ranges, see :func:`_download_segmented`.
+      Only applies when `to_file` is True.
+    :param sha256: Expected hex digest of the file. It's computed while the file is written, and
+      on mismatch the file is removed and an exception is raised. Only applies when `to_file` is True.
+    :param cache: Serves the response through the on-disk cache (see :mod:`pkg.http_cache`).
+      Meant for small metadata responses; ignored when `to_file` is True.
+
+    With `to_file`, a body up to :code:`MEMORY_SPOOL_SIZE` stays in memory, and a larger one is
+    spooled to disk and returned as an mmap-backed :class:`MappedFile`.
+
+    Concurrent calls for the same url share one request (see :class:`SingleFlight`):
+    each caller gets its own file object over the same buffered body or spool file.
+    """
     # Some interfaces like ZipFile need some additional methods.
     if to_file:
-        out_file = tempfile.TemporaryFile()
-        shutil.copyfileobj(res, out_file)
-        out_file.seek(0)
-        return out_file
+        return SINGLE_FLIGHT.do(
+            ('file', url, sha256),
+            lambda: _download_spooled(url, timeout, segmented, sha256, memory_limit=MEMORY_SPOOL_SIZE),
+            _open_sink)
+
+    if cache:
+        body = SINGLE_FLIGHT.do(('cached', url), lambda: _download_cached(url, timeout))
     else:
-        return res
+        body = SINGLE_FLIGHT.do(('body', url), lambda: _fetch(url, timeout).read())
+    return io.BytesIO(body)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+"""
+Extracts zip archives on a pool of workers.
+
+Directories are created first, then file entries are split between workers by size.
+Each worker reads the archive through its own :code:`ZipFile`, since a single one can't be
+read from several threads, and zlib releases the GIL while decompressing.
+"""
+
+import os
+import shutil
+import sys
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from .downloader import open_mapped, CHUNK_SIZE
+
+# Max concurrent workers extracting one archive
+MAX_WORKERS = 4
+
+# Archives with fewer files are extracted by one worker
+PARALLEL_THRESHOLD = 64
+
+
+def _target_path(dest, name):
+    # From ZipFile._extract_member
+    name = name.replace('/', os.path.sep)
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name)[1]
+    parts = [x for x in name.split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir)]
+    if sys.platform == 'win32' and hasattr(zipfile.ZipFile, '_sanitize_windows_name'):
+        parts = [zipfile.ZipFile._sanitize_windows_name(x, os.path.sep) for x in parts]
+        parts = [x for x in parts if x]
+    return os.path.join(dest, *parts) if parts else None
+
+
+def _extract_files(archive, members, store=None):
+    """
+    :returns: digests of the files linked from `store`
+    """
+    digests = []
+    f = zipfile.ZipFile(open_mapped(archive), 'r')
+    try:
+        for info, target in members:
+            if store is not None:
+                digests.append(store.extract(f, info, target))
+                continue
+
+            src = f.open(info)
+            try:
+                with open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            finally:
+                src.close()
+    finally:
+        f.close()
+    return digests
+
+
+def _split(members, count):
+    # Largest first, each to the worker with least bytes so far
+    buckets = [[] for _ in range(count)]
+    sizes = [0] * count
+    for member in sorted(members, key=lambda member: member[0].file_size, reverse=True):
+        index = sizes.index(min(sizes))
+        buckets[index].append(member)
+        sizes[index] += member[0].file_size
+    return [bucket for bucket in buckets if bucket]
+
+
+def extract(archive, dest, prefix='', workers=MAX_WORKERS, store=None):
+    """
+    Extracts entries of `archive` under `prefix` into `dest`, without the prefix.
+    Other entries are skipped.
+
+    :param archive: Path of the zip archive
+    :param prefix: Topmost folder of the entries, like :code:`'name-version/'`
+    :param store: :class:`~pkg.filestore.FileStore` to link files from, instead of writing them,
+      if it can share files. They are listed in :code:`dest`, see :meth:`~pkg.filestore.FileStore.record`.
+    """
+    f = zipfile.ZipFile(open_mapped(archive), 'r')
+    try:
+        infos = [info for info in f.infolist() if info.filename.startswith(prefix)]
+    finally:
+        f.close()
+
+    dirs = set([dest])
+    files = []
+    for info in infos:
+        target = _target_path(dest, info.filename[len(prefix):])
+        if target is None:
+            continue
+        if info.filename.endswith('/'):
+            dirs.add(target)
+        else:
+            dirs.add(os.path.dirname(target))
+            files.append((info, target))
+
+    for path in sorted(dirs):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    if store is not None and not store.sharing:
+        store = None
+
+    if len(files) < PARALLEL_THRESHOLD or workers <= 1:
+        digests = _extract_files(archive, files, store)
+    else:
+        buckets = _split(files, workers)
+        pool = ThreadPool(len(buckets))
+        try:
+            digests = sum(pool.map(lambda bucket: _extract_files(archive, bucket, store), buckets), [])
+        finally:
+            pool.close()
+
+    if store is not None:
+        store.record(dest, digests)
@@ -0,0 +1,260 @@
+"""
+Content-addressed store of package files, at :code:`g['path']['store']`.
+
+Files extracted from archives are kept once by the sha256 of their contents, and package
+directories are built from reflinks (copy-on-write clones) of them. Every entry is decompressed and
+hashed, since a zip only tells its CRC-32, which is trivial to collide. Where reflinks are not
+supported, packages are extracted as plain files, since copies would share nothing with the store.
+Each package directory lists the store files it was built from in :code:`.store.json`, and
+:meth:`FileStore.prune` removes files no package lists anymore.
+
+.. note ::
+    With :code:`g['file_store']['hardlink']`, hard links are used instead of copies. A hard-linked
+    file is shared with the store and other packages, so installers must not modify it in place.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from .compat import replace
+from .config import g
+from .downloader import CHUNK_SIZE
+from .http_cache import _write_atomic
+from .logger import getLogger
+
+log = getLogger(__name__)
+
+# ioctl(dest, FICLONE, src) of linux
+FICLONE = 0x40049409
+
+# Seconds a new file is kept by prune, while it may be being linked
+PRUNE_MIN_AGE = 60 * 60
+
+# Digests of store files a package directory was built from
+MANIFEST = '.store.json'
+
+# Copy-on-write clones are not supported by this filesystem
+_NOT_SUPPORTED = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EPERM)
+
+
+_clonefile_func = None
+
+
+def _clonefile():
+    global _clonefile_func
+    if _clonefile_func is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clonefile = libc.clonefile
+        clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+        clonefile.restype = ctypes.c_int
+        _clonefile_func = clonefile
+    return _clonefile_func
+
+
+def _reflink(src, dst):
+    if sys.platform.startswith('linux'):
+        import fcntl
+
+        with open(src, 'rb') as src_file:
+            with open(dst, 'wb') as dst_file:
+                try:
+                    fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                except (IOError, OSError):
+                    dst_file.close()
+                    os.unlink(dst)
+                    raise
+    elif sys.platform == 'darwin':
+        if _clonefile()(src.encode('utf8'), dst.encode('utf8'), 0) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    else:
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported')
+
+
+class FileStore(object):
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._probed = False
+
+        # Cleared by the probe, or at the first failure, e.g. the store is on another filesystem
+        self._reflink = True
+        self._hardlink = hasattr(os, 'link')
+
+    @property
+    def path(self):
+        path = self._path or g['path']['store']
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def _probe(self):
+        """
+        Clones a temporary file once, to know if reflinks are supported before storing any file.
+        """
+        with self._lock:
+            if self._probed:
+                return
+            self._probed = True
+
+            fd, src = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            os.write(fd, b'probe')
+            os.close(fd)
+            dst = src + '.tmp'
+            try:
+                _reflink(src, dst)
+            except (IOError, OSError, AttributeError) as e:
+                log.debug('Reflinks are not supported at %r: %s', self.path, e)
+                self._reflink = False
+            finally:
+                for path in (src, dst):
+                    if os.path.exists(path):
+                        os.unlink(path)
+
+    @property
+    def sharing(self):
+        """
+        False when files would only be copied from the store.
+        """
+        self._probe()
+        return self._reflink or (self._hardlink and g['file_store']['hardlink'])
+
+    def _file_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _add(self, src, digest):
+        """
+        Moves a file into the store as `digest`.
+
+        :returns: path of the stored file
+        """
+        path = self._file_path(digest)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Created by another worker
+                pass
+
+        if os.path.isfile(path):
+            os.unlink(src)
+            # Kept by prune while it's linked
+            os.utime(path, None)
+        else:
+            replace(src, path)
+        return path
+
+    def link(self, src, dst):
+        """
+        Creates `dst` as a reflink to `src`, or a copy of it (a hard link, if enabled).
+        """
+        if os.path.lexists(dst):
+            os.unlink(dst)
+
+        if self._reflink:
+            try:
+                _reflink(src, dst)
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in _NOT_SUPPORTED:
+                    raise
+                self._reflink = False
+
+        if self._hardlink and g['file_store']['hardlink']:
+            try:
+                os.link(src, dst)
+                return
+            except OSError as e:
+                if e.errno not in _NOT_SUPPORTED + (errno.EMLINK,):
+                    raise
+                self._hardlink = False
+
+        shutil.copyfile(src, dst)
+
+    def extract(self, zip_file, info, target):
+        """
+        Extracts a zip entry into `target` through the store.
+
+        :returns: sha256 hex digest of the entry
+        """
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            src = zip_file.open(info)
+            try:
+                with os.fdopen(fd, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                        dst.write(chunk)
+                        digest.update(chunk)
+            finally:
+                src.close()
+            path = self._add(tmp, digest.hexdigest())
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        self.link(path, target)
+        return os.path.basename(path)
+
+    @staticmethod
+    def record(dest, digests):
+        """
+        Lists store files of the package directory `dest`, see :meth:`prune`.
+        """
+        _write_atomic(os.path.join(dest, MANIFEST), json.dumps(sorted(set(digests))).encode('utf8'))
+
+    def prune(self):
+        """
+        Removes files not listed by any directory at :code:`g['path']['packages']`,
+        including backups and removed packages, nor hard-linked from one.
+        Package directories keep their own clones of removed files.
+
+        :returns: number of removed files
+        """
+        used = set()
+        packages = g['path']['packages']
+        for name in os.listdir(packages):
+            try:
+                with open(os.path.join(packages, name, MANIFEST), 'rb') as f:
+                    used.update(json.loads(f.read().decode('utf8')))
+            except (IOError, OSError, ValueError):
+                pass
+
+        removed = 0
+        now = time.time()
+        for parent, _, files in os.walk(self.path):
+            for name in files:
+                if parent == self.path:
+                    # Leftovers of interrupted extractions
+                    if not name.endswith('.tmp'):
+                        continue
+                elif name in used:
+                    continue
+                path = os.path.join(parent, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_nlink == 1 and now - stat.st_mtime > PRUNE_MIN_AGE:
+                        os.unlink(path)
+                        removed += 1
+                except OSError:
+                    pass
+
+            if parent != self.path:
+                try:
+                    # Only if empty
+                    os.rmdir(parent)
+                except OSError:
+                    pass
+        return removed
+
+
+FILE_STORE = FileStore()
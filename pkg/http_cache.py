@@ -0,0 +1,197 @@
+"""
+On-disk cache of repository responses, stored at :code:`g['path']['cache']`.
+
+Each entry keeps the response body with its validators (ETag / Last-Modified), so the
+downloader can send a conditional request and serve a 304 answer from disk.
+Permanent redirects are remembered here too.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .compat import replace
+from .config import g
+from .logger import getLogger
+
+log = getLogger(__name__)
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+class HTTPCache(object):
+    def __init__(self, path=None):
+        self._path = path
+
+    @property
+    def path(self):
+        path = self._path or os.path.join(g['path']['cache'], 'http')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def _entry_paths(self, url):
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        base = os.path.join(self.path, key)
+        return base + '.json', base + '.body'
+
+    def lookup(self, url):
+        """
+        Returns stored metadata for `url`, or None if it is not cached.
+
+        :rtype: dict or None
+        """
+        meta_path, body_path = self._entry_paths(url)
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = json.loads(f.read().decode('utf8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+        if meta.get('url') != url or not os.path.isfile(body_path):
+            return None
+        return meta
+
+    def is_fresh(self, meta, max_age=None):
+        if max_age is None:
+            max_age = g['http_cache']['max_age']
+        return time.time() - meta['stored_at'] < max_age
+
+    @staticmethod
+    def conditional_headers(meta):
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def read(self, url):
+        _, body_path = self._entry_paths(url)
+        with open(body_path, 'rb') as f:
+            return f.read()
+
+    def store(self, url, res, body):
+        """
+        Saves a 200 response. Responses without validators are kept only when a freshness
+        window is configured, since they cannot be revalidated.
+        """
+        etag = res.getheader('ETag', None)
+        last_modified = res.getheader('Last-Modified', None)
+        if not (etag or last_modified or g['http_cache']['max_age']):
+            return
+
+        meta_path, body_path = self._entry_paths(url)
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': time.time()
+        }
+        try:
+            _write_atomic(body_path, body)
+            _write_atomic(meta_path, json.dumps(meta).encode('utf8'))
+        except (IOError, OSError) as e:
+            log.debug('Failed to cache response from %r: %s', url, e)
+
+    def touch(self, url, meta):
+        """
+        Marks an entry as fresh again after the server answered 304.
+        """
+        meta_path, _ = self._entry_paths(url)
+        meta = dict(meta, stored_at=time.time())
+        try:
+            _write_atomic(meta_path, json.dumps(meta).encode('utf8'))
+        except (IOError, OSError) as e:
+            log.debug('Failed to update cache entry of %r: %s', url, e)
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+HTTP_CACHE = HTTPCache()
+
+
+class RedirectMemo(object):
+    """
+    Targets of permanent redirects (301, 308), in memory and at :code:`cache/redirects.json`.
+    """
+
+    # Hops followed in the memo, in case it has a cycle
+    MAX_HOPS = 10
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._targets = None
+
+    @property
+    def path(self):
+        return self._path or os.path.join(g['path']['cache'], 'redirects.json')
+
+    def _load(self):
+        if self._targets is None:
+            try:
+                with open(self.path, 'rb') as f:
+                    self._targets = json.loads(f.read().decode('utf8'))
+            except (IOError, OSError, ValueError):
+                self._targets = {}
+        return self._targets
+
+    def _save(self):
+        try:
+            _write_atomic(self.path, json.dumps(self._targets, indent=1).encode('utf8'))
+        except (IOError, OSError) as e:
+            log.debug('Failed to save redirects: %s', e)
+
+    def resolve(self, url):
+        with self._lock:
+            targets = self._load()
+            for _ in range(self.MAX_HOPS):
+                if url not in targets:
+                    break
+                url = targets[url]
+            return url
+
+    def remember(self, url, target):
+        with self._lock:
+            targets = self._load()
+            if targets.get(url) != target:
+                targets[url] = target
+                self._save()
+
+    def forget(self, url):
+        """
+        Removes `url` and the redirects following it.
+
+        :returns: True if `url` was remembered.
+        """
+        with self._lock:
+            targets = self._load()
+            if url not in targets:
+                return False
+            for _ in range(self.MAX_HOPS):
+                if url not in targets:
+                    break
+                url = targets.pop(url)
+            self._save()
+            return True
+
+
+REDIRECTS = RedirectMemo()
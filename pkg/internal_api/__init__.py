@@ -3,6 +3,7 @@ import collections
 import ctypes
 import os
 import sys
+import threading
 import traceback
 
 import idaapi
@@ -21,9 +22,17 @@ def _unique_items(items):
 
 
 def idausr_add(new):
+    idausr_extend([new])
+
+
+def idausr_extend(paths):
+    """
+    Appends `paths` to IDAUSR, applying it once.
+    """
     orig = idaapi.get_ida_subdirs('')
-    new = _unique_items(orig + [new])
-    _apply_idausr(new)
+    new = _unique_items(orig + list(paths))
+    if new != orig:
+        _apply_idausr(new)
 
 
 def idausr_remove(target):
@@ -55,7 +64,22 @@ def _ida_lib_path(ea):
     return os.path.normpath(path)
 
 
+# Native bindings are resolved once per process
+__ida_lib = None
+__lib_base = None
+__extlang_visitor = None
+__extlangs = None
+# The visitor fills one list, so it's run by one thread at once
+__extlangs_lock = threading.Lock()
+__get_idp_descs = None
+
+
 def _ida_lib():
+    global __ida_lib
+
+    if __ida_lib is not None:
+        return __ida_lib
+
     ea_name = 'ida64' if current_ea == 64 else 'ida'
     if current_os == 'win':
         functype = ctypes.WINFUNCTYPE
@@ -68,7 +92,18 @@ def _ida_lib():
         lib = getattr(ctypes.cdll, 'lib' + ea_name)
     else:
         raise RuntimeError("unknown os: %r" % current_os)
-    return functype, lib
+
+    __ida_lib = functype, lib
+    return __ida_lib
+
+
+def _lib_base():
+    global __lib_base
+
+    if __lib_base is None:
+        _, lib = _ida_lib()
+        __lib_base = _get_lib_base(lib)
+    return __lib_base
 
 
 def _get_lib_base(handle):
@@ -90,11 +125,16 @@ def _get_lib_base(handle):
         return info.dli_fbase
 
 
-def get_extlangs():
+def _get_extlang_visitor():
     """
-    Wrapper around get_extlangs() in C++ API.
+    :returns: (visitor, list filled by the visitor, objects kept alive for the visitor)
     """
-    functype, lib = _ida_lib()
+    global __extlang_visitor
+
+    if __extlang_visitor is not None:
+        return __extlang_visitor
+
+    functype, _ = _ida_lib()
 
     class _extlang_t(ctypes.Structure):
         _fields_ = [
@@ -136,16 +176,50 @@ def get_extlangs():
     vtable = (functype * 1)(_visitor_func)
     visitor = _extlang_visitor_t(vtable)
 
-    lib.for_all_extlangs(ctypes.pointer(visitor), False)
-    return res
+    # The callback and vtable are kept alive with the visitor
+    __extlang_visitor = visitor, res, (_visitor_func, vtable)
+    return __extlang_visitor
+
+
+def get_extlangs():
+    """
+    Wrapper around get_extlangs() in C++ API.
+    The result is cached until :func:`invalidate_extlangs` is called.
+    """
+    global __extlangs
+
+    with __extlangs_lock:
+        if __extlangs is None:
+            _, lib = _ida_lib()
+            visitor, res, _ = _get_extlang_visitor()
+
+            del res[:]
+            lib.for_all_extlangs(ctypes.pointer(visitor), False)
+            __extlangs = list(res)
+
+        return list(__extlangs)
+
+
+def invalidate_extlangs():
+    """
+    Forget extlangs cached by :func:`get_extlangs`, e.g. after loading plugins which may register one.
+    """
+    global __extlangs
+    with __extlangs_lock:
+        __extlangs = None
 
 
 def invalidate_proccache():
-    _, lib = _ida_lib()
-    # This returns proccache vector
-    func = lib.get_idp_descs
-    func.restype = ctypes.POINTER(ctypes.c_size_t)
-    ptr = func()
+    global __get_idp_descs
+
+    if __get_idp_descs is None:
+        _, lib = _ida_lib()
+        # This returns proccache vector
+        func = lib.get_idp_descs
+        func.restype = ctypes.POINTER(ctypes.c_size_t)
+        __get_idp_descs = func
+
+    ptr = __get_idp_descs()
     # Memory leak here, but not too much.
     ptr[1] = ptr[2] = 0
 
@@ -164,8 +238,7 @@ def _apply_idausr(new_value):
     cfg = g['idausr_native_bases'][current_os][version_info.str()]
     already_found = cfg[current_ea == 64]
 
-    _, lib = _ida_lib()
-    base = _get_lib_base(lib)
+    base = _lib_base()
 
     if already_found is False:
         __possible_to_invalidate = False
@@ -0,0 +1,72 @@
+"""
+Lockfiles pin a whole resolved install, so it can be repeated on other hosts without resolving
+against the repositories again. Written by :code:`pkg.install(spec, lockfile=path)`::
+
+    {
+        "lockfile_version": 1,
+        "root": "<name>",
+        "packages": {
+            "<name>": {
+                "version": "1.0.0",
+                "repo": "<repository url>",
+                "commit": "<commit of github releases, or null>",
+                "url": "<archive url>",
+                "sha256": "<archive digest>",
+                "dependencies": {"<name>": "<spec>"}
+            }
+        }
+    }
+"""
+
+import json
+
+from .logger import getLogger
+from .planner import InstallPlan
+
+LOCKFILE_VERSION = 1
+
+log = getLogger(__name__)
+
+
+def write_lockfile(plan, path):
+    """
+    Writes a lockfile pinning every package of a collected :class:`~pkg.planner.InstallPlan`.
+    """
+    lock = {
+        'lockfile_version': LOCKFILE_VERSION,
+        'root': plan.root.name,
+        'packages': plan.pin()
+    }
+    with open(path, 'wb') as f:
+        f.write(json.dumps(lock, indent=4, sort_keys=True).encode('utf8'))
+    log.info('Lockfile written to %r', path)
+
+
+def read_lockfile(path):
+    """
+    :returns: (name of the requested package, dict of name -> pinned entry)
+    """
+    with open(path, 'rb') as f:
+        lock = json.loads(f.read().decode('utf8'))
+
+    if lock.get('lockfile_version') != LOCKFILE_VERSION:
+        raise Exception('Unsupported lockfile version: %r' % lock.get('lockfile_version'))
+
+    packages = lock['packages']
+    for name, entry in packages.items():
+        missing = [key for key in ('version', 'repo', 'url', 'sha256') if not entry.get(key)]
+        if missing:
+            raise Exception('%r: Corrupted lockfile: %s of %r is missing' % (path, ', '.join(missing), name))
+
+    return lock['root'], packages
+
+
+def install_locked(path):
+    """
+    Installs exact versions pinned by a lockfile. Releases are not looked up; archives are
+    downloaded at once, and verified with their pinned digests.
+
+    :returns: LocalPackage of the requested package
+    """
+    root, packages = read_lockfile(path)
+    return InstallPlan().collect_locked(root, packages).apply()
@@ -91,5 +91,4 @@ def init_environment(_load=True):
         ifred.load()
         from . import actions
 
-    for pkg in LocalPackage.all():
-        pkg.populate_env()
+    LocalPackage.populate_env_all(LocalPackage.all())
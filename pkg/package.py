@@ -3,15 +3,15 @@ Package-related classes and methods are in pkg.package module. All constructing
 """
 
 import ctypes
-import glob
 import json
 import os
 import random
 import runpy
 import shutil
 import sys
+import threading
+import time
 import traceback
-import zipfile
 
 import ida_kernwin
 import ida_loader
@@ -19,9 +19,11 @@ import ida_diskio
 
 from .config import g
 from .env import ea as current_ea, os as current_os
-from .internal_api import invalidate_proccache, get_extlangs, idausr_remove, idausr_add
+from .filestore import FILE_STORE
+from .http_cache import _write_atomic
+from .internal_api import (
+    invalidate_proccache, get_extlangs, invalidate_extlangs, idausr_remove, idausr_add, idausr_extend)
 from .logger import getLogger
-from .vendor.semantic_version import Version, Spec
 from .virtualenv_utils import FixInterpreter
 
 __all__ = ["LocalPackage", "InstallablePackage"]
@@ -37,6 +39,14 @@ def rename(old, new):
         return os.rename(old, new)
 
 
+# Folders of loadable modules, listed in MODULES_MANIFEST
+MODULE_DIRS = ('plugins', 'procs', 'loaders')
+MODULES_MANIFEST = '.modules.json'
+
+# Staging directories of installs (pkg.planner) older than this (in seconds) are left by a crash
+STAGING_MAX_AGE = 60 * 60
+
+
 def _get_native_suffix():
     if current_os == 'win':
         suffix = '.dll'
@@ -49,29 +59,49 @@ def _get_native_suffix():
     return suffix
 
 
+class Manifest(object):
+    """
+    Parsed :code:`info.json` of an installed package. Fields have their defaults when missing.
+    """
+    __slots__ = ('raw', 'stamp', 'id', 'version', 'dependencies', 'installers', 'uninstallers',
+                 'restart_required')
+
+    def __init__(self, raw, stamp=None):
+        self.raw = raw
+        # (inode, mtime, size) of the file when it was parsed
+        self.stamp = stamp
+
+        self.id = str(raw['_id'])
+        self.version = str(raw['version'])
+        self.dependencies = raw.get('dependencies', {})
+        self.installers = raw.get('installers', [])
+        self.uninstallers = raw.get('uninstallers', [])
+        self.restart_required = bool(raw.get('restart_required', False))
+
+    @staticmethod
+    def load(path):
+        """
+        Parses :code:`info.json` at `path`.
+        """
+        stamp = _stat(path)
+        with open(path, 'rb') as _file:
+            return Manifest(json.load(_file), stamp)
+
+
 class LocalPackage(object):
-    def __init__(self, id, path, version):
+    def __init__(self, id, path, version, manifest=None):
         self.id = str(id)
         self.version = str(version)
 
         self.path = os.path.normpath(path)
+        self._manifest = manifest
+        self._modules = None
 
     def remove(self):
         """
         Removes a package.
         """
-        idausr_remove(self.path)
-
-        with FixInterpreter():
-            for script in self.info().get('uninstallers', []):
-                script = os.path.join(self.path, script)
-                try:
-                    runpy.run_path(script)
-                except Exception:
-                    # XXX: How can I rollback this?
-                    traceback.print_exc()
-                    log.warn(
-                        "Uninstallation script %r exited with exception!", script)
+        self.uninstall()
 
         if not LocalPackage._remove_package_dir(self.path):
             log.error(
@@ -85,9 +115,31 @@ class LocalPackage(object):
             rename(self.path, new_path)
             # XXX: is it good to mutate this object?
             self.path = new_path
+            REGISTRY.invalidate()
+
+        if g['file_store']['enabled']:
+            FILE_STORE.prune()
 
         log.info("Done!")
 
+    def uninstall(self):
+        """
+        Run python scripts specified by :code:`uninstallers` field in `info.json`,
+        after removing the package from IDAUSR variable. Files are kept.
+        """
+        idausr_remove(self.path)
+
+        with FixInterpreter():
+            for script in self.manifest().uninstallers:
+                script = os.path.join(self.path, script)
+                try:
+                    runpy.run_path(script)
+                except Exception:
+                    # XXX: How can I rollback this?
+                    traceback.print_exc()
+                    log.warn(
+                        "Uninstallation script %r exited with exception!", script)
+
     def install(self, remove_on_fail=False):
         """
         Run python scripts specified by :code:`installers` field in `info.json`.
@@ -97,8 +149,7 @@ class LocalPackage(object):
         orig_cwd = os.getcwd()
         try:
             os.chdir(self.path)
-            info = self.info()
-            scripts = info.get('installers', [])
+            scripts = self.manifest().installers
             if not isinstance(scripts, list):
                 raise Exception(
                     '%r: Corrupted package: installers key is not list' % self.id)
@@ -127,7 +178,7 @@ class LocalPackage(object):
 
         # XXX: find a more efficient way to ensure dependencies
         errors = []
-        for dependency in self.info().get('dependencies', {}).keys():
+        for dependency in self.manifest().dependencies.keys():
             dep = LocalPackage.by_name(dependency)
             if not dep:
                 errors.append('Dependency not found: %r' % dependency)
@@ -149,7 +200,14 @@ class LocalPackage(object):
             idausr_add(self.path)
 
             # Immediately load compatible plugins
-            self._find_loadable_modules('plugins', ida_loader.load_plugin)
+            loaded = []
+            self._find_loadable_modules('plugins', loaded.append)
+            for path in loaded:
+                ida_loader.load_plugin(path)
+
+            # Plugins may register extlangs
+            if loaded:
+                invalidate_extlangs()
 
             # Find loadable processor modules, and if exists, invalidate cached process list (proccache).
             invalidates = []
@@ -167,7 +225,7 @@ class LocalPackage(object):
         It's called at :code:`idapythonrc.py`.
         """
         errors = []
-        for dependency in self.info().get('dependencies', {}).keys():
+        for dependency in self.manifest().dependencies.keys():
             dep = LocalPackage.by_name(dependency)
             if not dep:
                 errors.append('Dependency not found: %r' % dependency)
@@ -184,6 +242,49 @@ class LocalPackage(object):
         if self.path not in sys.path:
             sys.path.append(self.path)
 
+    @staticmethod
+    def populate_env_all(packages):
+        """
+        :meth:`populate_env` of `packages` at once. Packages and their dependencies are ordered
+        in one pass, dependencies first, and IDAUSR variable is updated once.
+        """
+        paths = []
+        state = {}
+
+        def visit(pkg):
+            # True if pkg and its dependencies are found
+            if pkg.id in state:
+                # None while visiting: a cycle, which is resolved by the first visit
+                return state[pkg.id] is not False
+            state[pkg.id] = None
+
+            errors = []
+            for dependency in pkg.manifest().dependencies.keys():
+                dep = LocalPackage.by_name(dependency)
+                if not dep:
+                    errors.append('Dependency not found: %r' % dependency)
+                    continue
+                visit(dep)
+
+            if errors:
+                for error in errors:
+                    log.error(error)
+                state[pkg.id] = False
+                return False
+
+            state[pkg.id] = True
+            paths.append(pkg.path)
+            return True
+
+        for pkg in packages:
+            visit(pkg)
+
+        idausr_extend(paths)
+
+        for path in paths:
+            if path not in sys.path:
+                sys.path.append(path)
+
     def plugins(self):
         return self._collect_modules('plugins')
 
@@ -199,39 +300,99 @@ class LocalPackage(object):
         return result
 
     def _find_loadable_modules(self, subdir, callback):
+        entries = self.modules()[subdir]
+
         # Load modules in external languages (.py, .idc, ...)
         for suffix in ['.' + x.fileext for x in get_extlangs()]:
-            expr = os.path.join(self.path, subdir, '*' + suffix)
-            for path in glob.glob(expr):
-                callback(str(path))
+            for name, _ in entries:
+                if name.endswith(suffix):
+                    callback(str(os.path.join(self.path, subdir, name)))
 
         # Load native modules
-        for suffix in (_get_native_suffix(),):
-            expr = os.path.join(self.path, subdir, '*' + suffix)
-            for path in glob.glob(expr):
-                is64 = path[:-len(suffix)][-2:] == '64'
+        for name, is64 in entries:
+            if is64 is not None and is64 == (current_ea == 64):
+                callback(str(os.path.join(self.path, subdir, name)))
+
+    def modules(self):
+        """
+        Files in :code:`plugins`, :code:`procs` and :code:`loaders` folders, from
+        :code:`.modules.json` in the package directory. It's written at install time,
+        and again when mtimes of the folders change.
+
+        :returns: dict of folder -> list of (file name, is64). is64 is None if not a native module.
+        """
+        stamps = dict((subdir, _stat(os.path.join(self.path, subdir))) for subdir in MODULE_DIRS)
+        stamps = dict((subdir, stamp and stamp[1]) for subdir, stamp in stamps.items())
+        suffix = _get_native_suffix()
+
+        cached = self._modules
+        if cached is None:
+            try:
+                with open(os.path.join(self.path, MODULES_MANIFEST), 'rb') as _file:
+                    cached = json.loads(_file.read().decode('utf8'))
+            except (IOError, OSError, ValueError):
+                pass
+
+        if cached is None or cached.get('stamps') != stamps or cached.get('native_suffix') != suffix:
+            cached = {
+                'stamps': stamps,
+                'native_suffix': suffix,
+                'modules': dict((subdir, self._scan_modules(subdir, suffix)) for subdir in MODULE_DIRS)
+            }
+            try:
+                # Read by other threads through plugins() or load()
+                _write_atomic(os.path.join(self.path, MODULES_MANIFEST), json.dumps(cached).encode('utf8'))
+            except (IOError, OSError) as e:
+                log.debug('Failed to write module manifest of %r: %s', self.id, e)
 
-                if is64 == (current_ea == 64):
-                    callback(str(path))
+        self._modules = cached
+        return cached['modules']
+
+    def _scan_modules(self, subdir, suffix):
+        path = os.path.join(self.path, subdir)
+        if not os.path.isdir(path):
+            return []
+
+        result = []
+        for name, is_dir in sorted(_scandir(path)):
+            # Same as glob, which skips hidden files
+            if is_dir or name.startswith('.'):
+                continue
+            is64 = name[:-len(suffix)][-2:] == '64' if name.endswith(suffix) else None
+            result.append((name, is64))
+        return result
+
+    def manifest(self):
+        """
+        Parsed :code:`info.json`. It's parsed once, and again when the file changes.
+
+        :rtype: Manifest
+        """
+        info_json = os.path.join(self.path, 'info.json')
+        manifest = self._manifest
+        if manifest is None or manifest.stamp is None or manifest.stamp != _stat(info_json):
+            manifest = self._manifest = Manifest.load(info_json)
+        return manifest
 
     def info(self):
         """
         Loads :code:`info.json` and returns a parsed JSON object.
+        The object is cached (see :meth:`manifest`), and should not be modified.
 
         :rtype: dict
         """
-        with open(os.path.join(self.path, 'info.json'), 'rb') as _file:
-            return json.load(_file)
+        return self.manifest().raw
 
     @staticmethod
     def by_name(name, prefix=None):
         """
         Returns a package with specified `name`.
+        Packages at :code:`g['path']['packages']` are looked up in :data:`REGISTRY`.
 
         :rtype: LocalPackage
         """
-        if prefix is None:
-            prefix = g['path']['packages']
+        if prefix is None or prefix == g['path']['packages']:
+            return REGISTRY.get(name)
 
         path = os.path.join(prefix, name)
 
@@ -239,6 +400,10 @@ class LocalPackage(object):
         if not os.path.isdir(path):
             return None
 
+        return LocalPackage._load(path)
+
+    @staticmethod
+    def _load(path):
         # filter removed package
         removed = os.path.join(path, '.removed')
         if os.path.isfile(removed):
@@ -250,16 +415,15 @@ class LocalPackage(object):
             log.warn('Warning: info.json is not found at %r', path)
             return None
 
-        with open(info_json, 'rb') as _file:
-            try:
-                info = json.load(_file)
-            except Exception:
-                traceback.print_exc()
-                log.warn('Warning: info.json is not valid at %r', path)
-                return None
+        try:
+            manifest = Manifest.load(info_json)
+        except Exception:
+            traceback.print_exc()
+            log.warn('Warning: info.json is not valid at %r', path)
+            return None
 
         result = LocalPackage(
-            id=info['_id'], path=path, version=info['version'])
+            id=manifest.id, path=path, version=manifest.version, manifest=manifest)
         return result
 
     @staticmethod
@@ -269,15 +433,55 @@ class LocalPackage(object):
 
         :rtype: list(LocalPackage)
         """
-        prefix = g['path']['packages']
-
-        res = os.listdir(prefix)
-        res = (x for x in res if os.path.isdir(os.path.join(prefix, x)))
-        res = (LocalPackage.by_name(x) for x in res)
-        res = (x for x in res if x)
+        res = REGISTRY.all()
         res = [x for x in res if (x.id in g['ignored_packages']) == disabled]
         return res
 
+    @staticmethod
+    def _remove_if_marked(path):
+        if os.path.isfile(os.path.join(path, '.removed')):
+            LocalPackage._remove_package_dir(path)
+
+    @staticmethod
+    def _remove_if_stale(path):
+        try:
+            stale = time.time() - os.path.getmtime(path) > STAGING_MAX_AGE
+        except OSError:
+            return
+        if stale:
+            log.debug('Removing leftover staging directory %r', path)
+            LocalPackage._remove_package_dir(path)
+
+    @staticmethod
+    def _restore_if_orphaned(path):
+        """
+        Renames a backup of an install (pkg.planner) back to :code:`packages/<id>`, if it's missing
+        since the install crashed. Returns True if restored.
+        """
+        if os.path.isfile(os.path.join(path, '.removed')):
+            LocalPackage._remove_package_dir(path)
+            return False
+
+        # .backup-<id>-<random>
+        name = os.path.basename(path)[len('.backup-'):].rsplit('-', 1)[0]
+        install_path = os.path.join(os.path.dirname(path), name)
+        if os.path.exists(install_path):
+            try:
+                stale = time.time() - os.path.getmtime(path) > STAGING_MAX_AGE
+            except OSError:
+                return False
+            if stale:
+                log.warn('Backup of a previous version of %r is left at %r', name, path)
+            return False
+
+        log.warn('Restoring %r from its backup at %r', name, path)
+        try:
+            rename(path, install_path)
+        except OSError as e:
+            log.error('Failed to restore %r: %s', name, e)
+            return False
+        return True
+
     @staticmethod
     def _remove_package_dir(path):
         errors = []
@@ -292,6 +496,7 @@ class LocalPackage(object):
             # Mark for later removal
             open(os.path.join(path, '.removed'), 'wb').close()
 
+        REGISTRY.invalidate()
         return not errors
 
     def __repr__(self):
@@ -299,6 +504,111 @@ class LocalPackage(object):
                (self.id, self.path, self.version)
 
 
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def _scandir(path):
+    # (name, is directory) of entries in one pass
+    if hasattr(os, 'scandir'):
+        return [(entry.name, entry.is_dir()) for entry in os.scandir(path)]
+    return [(name, os.path.isdir(os.path.join(path, name))) for name in os.listdir(path)]
+
+
+class PackageRegistry(object):
+    """
+    Packages installed at :code:`g['path']['packages']` by directory name, which is their id.
+
+    The directory is scanned once, and again when its mtime changes. Each :code:`info.json` is
+    parsed once, and again when its mtime changes. Changes made by this process call
+    :meth:`invalidate`, since mtimes may be coarser than they are apart.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._prefix = None
+        self._stamp = None
+        self._packages = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._stamp = None
+
+    def _scan(self):
+        prefix = g['path']['packages']
+        stamp = _stat(prefix)
+        if prefix == self._prefix and stamp is not None and stamp == self._stamp:
+            return
+
+        entries = _scandir(prefix)
+        restored = False
+        for name, is_dir in entries:
+            if not is_dir or not name.startswith('.'):
+                continue
+            # Staging and backup directories of installs (pkg.planner)
+            path = os.path.join(prefix, name)
+            if name.startswith('.staging-'):
+                LocalPackage._remove_if_stale(path)
+            elif name.startswith('.backup-'):
+                restored = LocalPackage._restore_if_orphaned(path) or restored
+            else:
+                LocalPackage._remove_if_marked(path)
+
+        if restored:
+            entries = _scandir(prefix)
+            stamp = _stat(prefix)
+
+        known = self._packages if prefix == self._prefix else {}
+        packages = {}
+        for name, is_dir in entries:
+            if not is_dir or name.startswith('.'):
+                continue
+            path = os.path.join(prefix, name)
+
+            info_stamp = _stat(os.path.join(path, 'info.json'))
+            entry = known.get(name)
+            if entry is None or info_stamp is None or entry[0] != info_stamp:
+                entry = info_stamp, LocalPackage._load(path)
+            packages[name] = entry
+
+        self._prefix, self._stamp, self._packages = prefix, stamp, packages
+
+    def _validate(self, name):
+        entry = self._packages.get(name)
+        if entry is None:
+            return None
+
+        path = os.path.join(self._prefix, name)
+        info_stamp = _stat(os.path.join(path, 'info.json'))
+        if info_stamp is None or entry[0] != info_stamp:
+            entry = self._packages[name] = info_stamp, LocalPackage._load(path)
+        return entry[1]
+
+    def get(self, name):
+        """
+        :rtype: LocalPackage or None
+        """
+        with self._lock:
+            self._scan()
+            return self._validate(name)
+
+    def all(self):
+        """
+        :rtype: list(LocalPackage)
+        """
+        with self._lock:
+            self._scan()
+            res = (self._validate(name) for name in sorted(self._packages))
+            return [x for x in res if x]
+
+
+REGISTRY = PackageRegistry()
+
+
 class InstallablePackage(object):
     def __init__(self, id, name, version, description, author, repo):
         self.id = str(id)
@@ -308,126 +618,40 @@ class InstallablePackage(object):
         self.repo = repo
         self.author = author
 
-    def install(self, upgrade=False):
+    def install(self, upgrade=False, lockfile=None):
         """
-        Just calls :code:`InstallablePackage.install_from_repo(self.repo, self.id, upgrade)`.
+        Just calls :code:`InstallablePackage.install_from_repo(self.repo, self.id, upgrade, lockfile)`.
         """
-        install_from_repo(self.repo, self.id, allow_upgrade=upgrade)
+        install_from_repo(self.repo, self.id, allow_upgrade=upgrade, lockfile=lockfile)
 
     def __repr__(self):
         return '<InstallablePackage id=%r version=%r repo=%r>' % \
                (self.id, self.version, self.repo)
 
 
-def install_from_repo(repo, name, version_spec='*', allow_upgrade=False, _visited=None):
+def install_from_repo(repo, name, version_spec='*', allow_upgrade=False, lockfile=None):
     """
     This method downloads a package satisfying spec.
 
+    The dependency graph is collected first, and archives are downloaded and extracted concurrently.
+    See :class:`~pkg.planner.InstallPlan`.
+
+    :param lockfile: If given, a lockfile pinning the installed tree is written to this path.
+      See :mod:`pkg.lockfile`.
+
     .. note ::
         The function waits until all of dependencies are installed.
         Run it as separate thread if possible.
     """
+    from .planner import InstallPlan
+    from .lockfile import write_lockfile
 
-    top_level = _visited is None
-    _visited = _visited or {}
-
-    if name in _visited:
-        log.warn("Cyclic dependency found when installing %r <-> %r",
-                 name, _visited)
-        return
-
-    prev = LocalPackage.by_name(name)
-
-    _version_spec = Spec(version_spec)
-    satisfies_local = prev and Version(prev.version) in _version_spec
-
-    if allow_upgrade or not satisfies_local:
-        log.debug("Fetching releases for %r from %r...", name, repo)
-
-        releases = repo.releases(name)
-        if not releases:
-            error = "Release not found on remote repository: %r on %r (error: %r)" % (
-                name, repo, releases['error'])
-            raise Exception(error)
-
-        releases = [release for release in releases
-                    if Version(release['version']) in _version_spec]
-
-        if not releases:
-            error = "Release satisfying the condition %r %r not found on remote repository %r" % (
-                name, version_spec, repo)
-            raise Exception(error)
-        downloading = None if (
-                prev and releases[-1]['version'] == prev.version) else releases[-1]['version']
-    else:
-        downloading = None
-
-    if downloading:
-        log.info('Collecting %s...', name)
-        data = repo.download(name, downloading)
-        f = zipfile.ZipFile(data, 'r')
-
-        # No  /: topmost files
-        # One /: topmost folders
-        topmost_files = [path for path in f.namelist() if path.count('/') == 0]
-        # From ZipInfo.is_dir() in Python 3.x
-        topmost_folders = [path for path in f.namelist() if path.endswith('/')]
-        common_prefix = topmost_folders[0] if len(topmost_files) == 0 and len(topmost_folders) == 1 else ""
-
-        info = json.load(f.open(common_prefix + 'info.json'))
-        packages_path = g['path']['packages']
-        install_path = os.path.join(packages_path, info["_id"])
-
-        # this ensures os.path.exists(install_path) == False
-        # TODO: should we unload a already-loaded plugin?
-        if prev:
-            prev.remove()
-            assert not os.path.exists(install_path)
-
-        # XXX: edge case?
-        removed = os.path.join(install_path, '.removed')
-        if os.path.isfile(removed):
-            os.unlink(removed)
-
-        log.info('Extracting into %r...', install_path)
-        if common_prefix:
-            f.extractall(packages_path)
-            os.rename(os.path.join(packages_path, common_prefix), install_path)
-        else:
-            f.extractall(install_path)
-
-        # Initiate LocalPackage object
-        pkg = LocalPackage(info['_id'], install_path, info['version'])
-    else:
-        pkg = prev
-
-        log.info("Requirement already satisfied: %s%s",
-                 name, '' if version_spec == '*' else version_spec)
-
-    restart_required = pkg.info().get('restart_required', False)
-    _visited[name] = (pkg.version, restart_required)
-
-    # First, install dependencies
-    # TODO: add version check
-    for dep_name, dep_version_spec in pkg.info().get('dependencies', {}).items():
-        install_from_repo(repo, dep_name, dep_version_spec, allow_upgrade, _visited)
-
-    # Then, install this package.
-    if downloading:
-        pkg.install()
-
-    if not restart_required:
-        pkg.load()
-
-    if top_level:
-        log.info("Successfully installed %s",
-                 ' '.join('%s-%s' % (key, value[0]) for key, value in _visited.items()))
-
-        delayed = [(key, value) for key, value in _visited.items() if value[1]]
-        if delayed:
-            log.info(
-                "Plugins in the following packages will be loaded after restarting IDA.")
-            log.info(
-                "  %s", " ".join('%s-%s' % (key, value[0]) for key, value in delayed))
+    if allow_upgrade:
+        # Releases may have been memoized before this upgrade
+        repo.invalidate_releases()
 
+    plan = InstallPlan(repo, allow_upgrade).collect(name, version_spec)
+    pkg = plan.apply()
+    if lockfile:
+        write_lockfile(plan, lockfile)
     return pkg
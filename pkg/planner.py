@@ -0,0 +1,391 @@
+"""
+Installation planner.
+
+The whole dependency graph is resolved before any installed package is touched, and archives are
+fetched on a bounded pool of workers while it's resolved. Then archives are extracted at once,
+and packages are installed and loaded in topological order. Archives of the plan are pinned in the
+archive store until it's applied, so fetching one doesn't evict another.
+"""
+
+import os
+import random
+import sys
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from .config import g
+from .extract import extract
+from .filestore import FILE_STORE
+from .logger import getLogger
+from .package import LocalPackage, REGISTRY, rename
+from .repo import Repository
+from .resolver import Resolver, _read_info
+from .store import ARCHIVE_STORE
+
+# Max concurrent downloads and extractions
+MAX_CONCURRENT = 8
+
+log = getLogger(__name__)
+
+
+def _aside_path(path, kind):
+    # Dot-prefixed directories are not listed as packages
+    return os.path.join(os.path.dirname(path), '.%s-%s-%x' % (
+        kind, os.path.basename(path.rstrip('/\\')), random.getrandbits(64)))
+
+
+def _mark_removed(path):
+    # Removed later by LocalPackage.all, see LocalPackage._remove_package_dir
+    open(os.path.join(path, '.removed'), 'wb').close()
+
+
+def _call(func, arg):
+    # ThreadPool drops exceptions of apply_async without error_callback (python 2)
+    try:
+        return arg, func(arg), None
+    except Exception as e:
+        log.debug('%r failed:\n%s', arg, traceback.format_exc())
+        return arg, None, e
+
+
+class PlannedPackage(object):
+    """
+    A node of the dependency graph. Fields are filled while the plan is collected.
+    """
+
+    def __init__(self, name, version_spec, repo):
+        self.name = name
+        self.version_spec = version_spec
+        self.repo = repo
+
+        # Installed version, if any
+        self.prev = None
+        self.version = None
+        self.info = None
+
+        # Set if a new release is going to be installed
+        self.release = None
+        self.url = None
+        self.archive = None
+        self.common_prefix = ''
+
+        # LocalPackage to install and load
+        self.pkg = None
+
+        # Lockfile entry, see InstallPlan.pin
+        self.pinned = None
+
+        # State of a staged install, see InstallPlan.apply
+        self.staging = None
+        self.staged = None
+        self.backup = None
+        self.uninstalled = False
+
+    @property
+    def downloading(self):
+        return self.release is not None
+
+    @property
+    def dependencies(self):
+        return self.info.get('dependencies', {})
+
+    @property
+    def restart_required(self):
+        return self.info.get('restart_required', False)
+
+    def __repr__(self):
+        return '<PlannedPackage name=%r version=%r downloading=%r>' % \
+               (self.name, self.version, self.downloading)
+
+
+class InstallPlan(object):
+    """
+    Installs a package from `repo` with its dependencies,
+    or the packages pinned by a lockfile (see :meth:`collect_locked`).
+    """
+
+    def __init__(self, repo=None, allow_upgrade=False, max_workers=MAX_CONCURRENT):
+        self.repo = repo
+        self.allow_upgrade = allow_upgrade
+        self.max_workers = max_workers
+        self.nodes = {}
+        self.root = None
+
+        # Archives pinned in ARCHIVE_STORE until the plan is applied
+        self._pins = []
+
+    def collect(self, name, version_spec='*'):
+        """
+        Resolves versions of `name` and its dependencies, then fetches archives of packages to be installed.
+        Nothing is installed or removed yet. See :class:`~pkg.resolver.Resolver`.
+        """
+        pool = ThreadPool(self.max_workers)
+        try:
+            resolver = Resolver(self.repo, self.allow_upgrade, pool)
+            versions = resolver.resolve(name, version_spec)
+        finally:
+            pool.close()
+
+        for dep_name, version in versions.items():
+            specs = [spec for spec, _ in resolver.requirements[dep_name] if spec != '*']
+            node = PlannedPackage(dep_name, ','.join(specs) or '*', self.repo)
+            node.prev = resolver.installed(dep_name)
+            node.version = version
+
+            if node.prev and node.prev.version == version:
+                log.info("Requirement already satisfied: %s%s",
+                         dep_name, '' if node.version_spec == '*' else node.version_spec)
+                node.info = node.prev.info()
+                node.pkg = node.prev
+            else:
+                node.release = resolver.release(dep_name, version)
+
+            self.nodes[dep_name] = node
+
+        self.root = self.nodes[name]
+        self._fetch_all()
+        return self
+
+    def collect_locked(self, root, packages):
+        """
+        Plans to install exact versions pinned by a lockfile, without resolving or fetching releases.
+        See :mod:`pkg.lockfile`.
+
+        :param root: Name of the requested package
+        :param packages: dict of name -> pinned entry
+        """
+        for name, entry in packages.items():
+            node = PlannedPackage(name, '==' + entry['version'], Repository.from_url(entry['repo']))
+            node.prev = LocalPackage.by_name(name)
+            node.version = entry['version']
+
+            if node.prev and node.prev.version == node.version:
+                log.info("Requirement already satisfied: %s%s", name, node.version_spec)
+                node.info = node.prev.info()
+                node.pkg = node.prev
+            else:
+                node.release = entry
+                node.url = entry['url']
+
+            self.nodes[name] = node
+
+        self.root = self.nodes[root]
+        self._fetch_all()
+        return self
+
+    def _fetch_all(self):
+        try:
+            self._map(self._fetch, [node for node in self.nodes.values() if node.release is not None])
+        except Exception:
+            self._unpin()
+            raise
+
+    def _fetch(self, node):
+        log.info('Collecting %s...', node.name)
+        # Archives read by the resolver are looked up in the store again, and pinned this time
+        node.archive = ARCHIVE_STORE.fetch(
+            node.repo, node.name, node.version, node.release.get('sha256'), url=node.url, pin=True)
+        self._pins.append(node.archive)
+        node.common_prefix, node.info = _read_info(node.archive)
+
+    def _unpin(self):
+        pins, self._pins = self._pins, []
+        if pins:
+            ARCHIVE_STORE.unpin(pins)
+
+    def pin(self):
+        """
+        Pins every package of the plan: version, source repository, commit and archive digest.
+        Archives of packages which were already installed are fetched to know their digests.
+
+        :returns: dict of name -> pinned entry
+        """
+        self._map(self._pin, list(self.nodes.values()))
+        return dict((node.name, node.pinned) for node in self.nodes.values())
+
+    def _pin(self, node):
+        release = node.release
+        if release is None:
+            release = next((item for item in node.repo.releases(node.name) or []
+                            if item['version'] == node.version), {})
+
+        url = node.url or node.repo.archive_url(node.name, node.version)
+        archive = node.archive or ARCHIVE_STORE.fetch(
+            node.repo, node.name, node.version, release.get('sha256'), url=url)
+
+        node.pinned = {
+            'version': node.version,
+            'repo': node.repo.url,
+            'commit': release.get('commit'),
+            'url': url,
+            'sha256': ARCHIVE_STORE.digest(archive),
+            'dependencies': node.dependencies
+        }
+
+    def order(self):
+        """
+        Collected packages in topological order, dependencies first.
+
+        :rtype: list(PlannedPackage)
+        """
+        result = []
+        visiting = []
+        done = set()
+
+        def visit(node):
+            if node.name in done:
+                return
+            if node.name in visiting:
+                log.warn("Cyclic dependency found when installing %r <-> %r",
+                         node.name, visiting)
+                return
+
+            visiting.append(node.name)
+            for dep_name in node.dependencies:
+                if dep_name in self.nodes:
+                    visit(self.nodes[dep_name])
+            visiting.pop()
+
+            done.add(node.name)
+            result.append(node)
+
+        visit(self.root)
+        return result
+
+    def _map(self, func, nodes):
+        if not nodes:
+            return
+        pool = ThreadPool(min(self.max_workers, len(nodes)))
+        try:
+            results = pool.map(lambda node: _call(func, node), nodes)
+        finally:
+            pool.close()
+
+        for _, _, error in results:
+            if error is not None:
+                raise error
+
+    def _extract(self, node):
+        # Archives are extracted at once, and their topmost folders may have the same name.
+        # Not mkdtemp, whose mode 0700 would be kept by the installed package.
+        node.staging = _aside_path(os.path.join(g['path']['packages'], node.info['_id']), 'staging')
+        os.mkdir(node.staging)
+
+        log.info('Extracting %s-%s...', node.name, node.version)
+        extract(node.archive, node.staging, node.common_prefix,
+                store=FILE_STORE if g['file_store']['enabled'] else None)
+
+        node.staged = LocalPackage(node.info['_id'], node.staging, node.version)
+
+    def _stage(self, node):
+        """
+        Runs installers of a staged package, then swaps it into :code:`packages/<id>`.
+        The previous version is kept aside until the whole plan succeeds.
+        """
+        if node.prev:
+            node.prev.uninstall()
+            node.uninstalled = True
+
+        node.staged.install()
+        # Module manifest, after installers which may add modules
+        node.staged.modules()
+
+        install_path = os.path.join(g['path']['packages'], node.info['_id'])
+        if node.prev:
+            node.backup = _aside_path(node.prev.path, 'backup')
+            rename(node.prev.path, node.backup)
+        if os.path.exists(install_path):
+            # Leftover of a removal which failed
+            leftover = _aside_path(install_path, 'removed')
+            rename(install_path, leftover)
+            _mark_removed(leftover)
+
+        rename(node.staged.path, install_path)
+        REGISTRY.invalidate()
+        node.pkg = LocalPackage(node.info['_id'], install_path, node.version)
+
+        # Installers of dependents may import this package
+        if install_path not in sys.path:
+            sys.path.append(install_path)
+
+    def _rollback(self, node):
+        if node.pkg is not None:
+            discarded = _aside_path(node.pkg.path, 'removed')
+            rename(node.pkg.path, discarded)
+            _mark_removed(discarded)
+            if node.pkg.path in sys.path:
+                sys.path.remove(node.pkg.path)
+
+        if node.backup is not None:
+            rename(node.backup, node.prev.path)
+        REGISTRY.invalidate()
+
+        if node.uninstalled:
+            log.info('Restoring %s-%s...', node.name, node.prev.version)
+            node.prev.install()
+            node.prev.populate_env()
+
+    def _cleanup(self, node):
+        for path in (node.backup, node.staging):
+            if path is not None and os.path.exists(path):
+                if not LocalPackage._remove_package_dir(path):
+                    log.error("%r is in use and will be removed after restart.", path)
+
+    def apply(self):
+        """
+        Extracts collected archives at once into staging directories, then installs packages
+        in topological order, and loads them after all of them are installed.
+
+        Installers run in the staging directory, and each package is renamed into
+        :code:`packages/<id>` after its installers succeed. If any of them fails,
+        every package of the plan is swapped back to its previous version.
+
+        :returns: LocalPackage of the requested package
+        """
+        order = self.order()
+        downloading = [node for node in order if node.downloading]
+
+        try:
+            self._map(self._extract, downloading)
+
+            # TODO: should we unload a already-loaded plugin?
+            done = []
+            try:
+                for node in downloading:
+                    done.append(node)
+                    self._stage(node)
+            except Exception:
+                log.error('Installation failed, rolling back...')
+                for node in reversed(done):
+                    try:
+                        self._rollback(node)
+                    except Exception:
+                        log.error('Rollback of %s failed:\n%s', node.name, traceback.format_exc())
+                        if node.backup is not None and os.path.exists(node.backup):
+                            # Not removed by _cleanup, to be restored by hand
+                            log.error('Previous version of %s is kept at %r', node.name, node.backup)
+                            node.backup = None
+                raise
+        finally:
+            for node in downloading:
+                self._cleanup(node)
+            self._unpin()
+
+        if downloading and g['file_store']['enabled']:
+            FILE_STORE.prune()
+
+        for node in order:
+            if not node.restart_required:
+                node.pkg.load()
+
+        log.info("Successfully installed %s",
+                 ' '.join('%s-%s' % (node.name, node.version) for node in order))
+
+        delayed = [node for node in order if node.restart_required]
+        if delayed:
+            log.info(
+                "Plugins in the following packages will be loaded after restarting IDA.")
+            log.info(
+                "  %s", " ".join('%s-%s' % (node.name, node.version) for node in delayed))
+
+        return self.root.pkg
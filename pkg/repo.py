@@ -1,6 +1,9 @@
 from __future__ import print_function
 
 import json
+import multiprocessing
+import threading
+import time
 import traceback
 from multiprocessing.pool import ThreadPool
 
@@ -9,6 +12,7 @@ from .config import g
 from .downloader import download
 from .logger import getLogger
 from .package import InstallablePackage
+from .vendor.semantic_version import Version
 
 # Connection timeout
 TIMEOUT = 8
@@ -16,14 +20,23 @@ TIMEOUT = 8
 # Max concurrent when fetching multiple repository
 MAX_CONCURRENT = 10
 
+# Seconds a release list is reused by the same Repository object
+RELEASES_TTL = 60
+
 log = getLogger(__name__)
 
 
 class Repository(object):
     """
     An instance of this class represents a single repository.
+    Release lists are memoized per instance for :code:`RELEASES_TTL` seconds,
+    so an instance used through one install fetches each package's releases once.
     """
 
+    def __init__(self):
+        self._releases = {}
+        self._releases_lock = threading.Lock()
+
     def get(self, name):
         """
         Fetch metadata for single package from the repo.
@@ -47,8 +60,48 @@ class Repository(object):
         """
         Fetch a list of releases of specified package.
         """
+        now = time.time()
+        with self._releases_lock:
+            cached = self._releases.get(name)
+        if cached is not None and now - cached[0] < RELEASES_TTL:
+            return cached[1]
+
+        releases = self._fetch_releases(name)
+        if releases is not None:
+            with self._releases_lock:
+                self._releases[name] = now, releases
+        return releases
+
+    def invalidate_releases(self, name=None):
+        """
+        Forget memoized releases of `name`, or of all packages.
+        """
+        with self._releases_lock:
+            if name is None:
+                self._releases.clear()
+            else:
+                self._releases.pop(name, None)
+
+    def _fetch_releases(self, name):
+        raise NotImplementedError
+
+    def archive_url(self, name, version):
+        """
+        URL of the zip archive of a release.
+
+        :rtype: str
+        """
         raise NotImplementedError
 
+    def download(self, name, version, sha256=None):
+        """
+        Download the zip archive of a release.
+
+        :param sha256: Expected hex digest of the archive. Releases may carry it as :code:`release['sha256']`.
+        :returns: seekable temporary file
+        """
+        return download(self.archive_url(name, version), to_file=True, segmented=True, sha256=sha256)
+
     @staticmethod
     def from_url(url):
         def old_repo(name):
@@ -77,12 +130,13 @@ class OldRepository(Repository):
     """
 
     def __init__(self, url, timeout=TIMEOUT):
+        super(OldRepository, self).__init__()
         self.url = url
         self.timeout = timeout
 
     def get(self, name):
         endpoint = '/info?id=' + quote(name)
-        res = download(self.url + endpoint, self.timeout)
+        res = download(self.url + endpoint, self.timeout, cache=True)
         if not res:  # Network Error
             return
 
@@ -97,7 +151,7 @@ class OldRepository(Repository):
 
     def list(self):
         endpoint = '/search'
-        res = download(self.url + endpoint, self.timeout)
+        res = download(self.url + endpoint, self.timeout, cache=True)
         try:
             if res is None:
                 raise Exception('connection error')
@@ -115,9 +169,9 @@ class OldRepository(Repository):
             log.error('Error fetching repo: %r\n%s',
                       self.url, traceback.format_exc())
 
-    def releases(self, name):
+    def _fetch_releases(self, name):
         endpoint = '/releases?name=' + quote(name)
-        res = download(self.url + endpoint)
+        res = download(self.url + endpoint, cache=True)
 
         if res is None:
             return None
@@ -128,9 +182,9 @@ class OldRepository(Repository):
         else:
             return releases['data']
 
-    def download(self, name, version):
+    def archive_url(self, name, version):
         endpoint = '/download?spec=' + quote(name) + '==' + quote(version)
-        return download(self.url + endpoint, to_file=True)
+        return self.url + endpoint
 
     def __repr__(self):
         return "<OldRepository url=%r>" % self.url
@@ -145,20 +199,22 @@ class GitHubRepository(Repository):
     API_ARCHIVE = 'https://github.com/{0}/archive/{1}.zip'
 
     def __init__(self, repo, timeout=TIMEOUT):
+        super(GitHubRepository, self).__init__()
         assert self._is_valid_repo(repo)
         self.repo = repo
+        self.url = 'github:' + repo
         self.timeout = timeout
 
     def get(self, name):
         endpoint = 'info/{0}.json'.format(quote(name))
-        res = download(self.API_BLOB.format(self.repo, endpoint))
+        res = download(self.API_BLOB.format(self.repo, endpoint), cache=True)
         item = json.load(res)
         return InstallablePackage(
             name=item['name'], id=item['id'], version=item['version'], description=item['description'],
             author=item['author'], repo=self)
 
     def list(self):
-        res = download(self.API_BLOB.format(self.repo, '/list.json'))
+        res = download(self.API_BLOB.format(self.repo, '/list.json'), cache=True)
         items = json.load(res)
         return [
             InstallablePackage(
@@ -167,21 +223,19 @@ class GitHubRepository(Repository):
             for item in items
         ]
 
-    def releases(self, name):
+    def _fetch_releases(self, name):
         endpoint = 'releases/{0}.json'.format(quote(name))
-        res = download(self.API_BLOB.format(self.repo, endpoint))
+        res = download(self.API_BLOB.format(self.repo, endpoint), cache=True)
         return json.load(res)
 
-    def download(self, name, version):
-        endpoint = 'releases/{0}.json'.format(quote(name))
-        releases = json.load(download(self.API_BLOB.format(self.repo, endpoint)))
-        for release in releases:
+    def archive_url(self, name, version):
+        for release in self.releases(name):
             if release['version'] == version:
                 repo = release['repo']
                 commit = release['commit']
                 assert self._is_valid_repo(repo)
                 assert self._is_valid_commit(commit)
-                return download(self.API_ARCHIVE.format(repo, commit), to_file=True)
+                return self.API_ARCHIVE.format(repo, commit)
 
         raise Exception("release not found! (%s==%s)" % (name, version))
 
@@ -228,26 +282,123 @@ class GitHubRepository(Repository):
         return "<GitHubRepository repo=%r>" % self.repo
 
 
-def get_online_packages(repos=None):
+def _list_repo(repo):
+    try:
+        return repo, repo.list()
+    except Exception:
+        log.error('Error fetching repo: %r\n%s', repo, traceback.format_exc())
+        return repo, None
+
+
+def iter_online_packages(repos=None, deadline=None):
     """
-    Generates a list of packages from specified repositories.
+    Fetches packages from specified repositories at once, and yields them per repository
+    as soon as each one answers.
 
     :param repos: Array of repository urls (string). Default: g['repos']
     :type repos: list(str) or None
-    :returns: list(:class:`~pkg.package.InstallablePackage`) from each repos.
+    :param deadline: Seconds to wait for all repositories. Repositories not answering by then are skipped.
+    :returns: generator of (:class:`Repository`, list(:class:`~pkg.package.InstallablePackage`))
     """
 
     if repos is None:
         repos = g['repos']
 
     repos = [Repository.from_url(url) for url in repos]
+    end = None if deadline is None else time.time() + deadline
 
     pool = ThreadPool(MAX_CONCURRENT)
-    results = pool.map(lambda repo: repo.list(), repos)
-    results = [pkgs for pkgs in results if pkgs]
+    results = pool.imap_unordered(_list_repo, repos)
+    pending = set(repos)
+    try:
+        while pending:
+            try:
+                repo, pkgs = results.next(None if end is None else max(0, end - time.time()))
+            except multiprocessing.TimeoutError:
+                log.error('Repositories not answering in %d seconds: %s',
+                          deadline, ', '.join(repr(repo) for repo in pending))
+                return
+            pending.discard(repo)
+            if pkgs is not None:
+                yield repo, pkgs
+    finally:
+        pool.close()
+
+
+def find_package(name, repos=None, mode='priority'):
+    """
+    Looks up a package in all specified repositories at once.
+
+    :param repos: Array of repository urls (string). Default: g['repos']
+    :type repos: list(str) or None
+    :param mode: Which hit is returned.
+      :code:`'first'`: from the repository answering first.
+      :code:`'priority'`: from the earliest repository in `repos` having it, as soon as the earlier ones answered.
+      :code:`'version'`: the highest version, after all repositories answered.
+    :returns: None if package is not found, else InstallablePackage instance.
+    :rtype: pkg.package.InstallablePackage or None
+    """
+    assert mode in ('first', 'priority', 'version'), mode
+
+    if repos is None:
+        repos = g['repos']
+
+    repos = [Repository.from_url(url) for url in repos]
+    if not repos:
+        return None
+
+    cancelled = threading.Event()
+
+    def lookup(args):
+        index, repo = args
+        # Requests which already started can't be stopped, but queued ones are skipped
+        if cancelled.is_set():
+            return index, None
+        try:
+            return index, repo.get(name)
+        except Exception as e:
+            log.debug('Error looking up %r in %r: %s', name, repo, e)
+            return index, None
+
+    pool = ThreadPool(min(MAX_CONCURRENT, len(repos)))
+    results = pool.imap_unordered(lookup, enumerate(repos))
+    found = [None] * len(repos)
+    answered = [False] * len(repos)
+    try:
+        for _ in repos:
+            index, pkg = results.next()
+            answered[index] = True
+            found[index] = pkg
+
+            if mode == 'first' and pkg is not None:
+                return pkg
+            if mode == 'priority':
+                for hit, done in zip(found, answered):
+                    if not done:
+                        break
+                    if hit is not None:
+                        return hit
+    finally:
+        cancelled.set()
+        pool.close()
+
+    hits = [pkg for pkg in found if pkg is not None]
+    if not hits:
+        return None
+    # max() keeps the earliest repository on ties
+    return max(hits, key=lambda pkg: Version(pkg.version))
+
+
+def get_online_packages(repos=None, deadline=None):
+    """
+    Generates a list of packages from specified repositories.
+    See :func:`iter_online_packages` for the arguments.
+
+    :returns: list(:class:`~pkg.package.InstallablePackage`) from each repos.
+    """
 
     # flatten results
-    return [pkg for pkgs in results for pkg in pkgs]
+    return [pkg for _, pkgs in iter_online_packages(repos, deadline) for pkg in pkgs]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+"""
+Backtracking resolver of package versions.
+
+Each package gets one version satisfying every spec its dependents declare. Candidates are tried
+newest first (the installed version first, unless upgrading), and a choice whose dependencies
+conflict with earlier choices is undone. Dependencies of a release are read from
+:code:`release['dependencies']` when the repository provides it, or from :code:`info.json` in its
+archive, which is fetched through the archive store.
+"""
+
+import json
+import threading
+import zipfile
+
+from .downloader import open_mapped
+from .logger import getLogger
+from .package import LocalPackage
+from .store import ARCHIVE_STORE
+from .vendor.semantic_version import Version, Spec
+
+# Conflicts listed in the error when resolution fails
+MAX_REPORTED_CONFLICTS = 5
+
+log = getLogger(__name__)
+
+
+def _read_info(archive):
+    f = zipfile.ZipFile(open_mapped(archive), 'r')
+    try:
+        names = f.namelist()
+        # No  /: topmost files
+        # One /: topmost folders
+        topmost_files = [path for path in names if path.count('/') == 0]
+        # From ZipInfo.is_dir() in Python 3.x
+        topmost_folders = [path for path in names if path.endswith('/')]
+        common_prefix = topmost_folders[0] if len(topmost_files) == 0 and len(topmost_folders) == 1 else ""
+        return common_prefix, json.loads(f.read(common_prefix + 'info.json').decode('utf8'))
+    finally:
+        f.close()
+
+
+def _describe(requirements):
+    return ', '.join('%s (%s)' % (spec, 'requested' if by is None else 'required by %s' % by)
+                     for spec, by in requirements)
+
+
+class Resolver(object):
+    """
+    Resolves versions of a package and its dependencies from `repo`.
+
+    :param allow_upgrade: Prefer the newest releases over installed versions.
+    :param pool: ThreadPool used to fetch releases and archives ahead of the search.
+    """
+
+    def __init__(self, repo, allow_upgrade=False, pool=None):
+        self.repo = repo
+        self.allow_upgrade = allow_upgrade
+        self.pool = pool
+
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+        # Memos. Spec and Version objects, and match results are reused through the search.
+        self._specs = {}
+        self._versions = {}
+        self._matches = {}
+        self._installed = {}
+        self._releases = {}
+        self._dependencies = {}
+        self._warmed = set()
+
+        self.requirements = {}
+        self._conflicts = []
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _spec(self, spec):
+        result = self._specs.get(spec)
+        if result is None:
+            result = self._specs[spec] = Spec(spec)
+        return result
+
+    def _version(self, version):
+        result = self._versions.get(version)
+        if result is None:
+            result = self._versions[version] = Version(version)
+        return result
+
+    def _match(self, spec, version):
+        key = spec, version
+        result = self._matches.get(key)
+        if result is None:
+            result = self._matches[key] = self._version(version) in self._spec(spec)
+        return result
+
+    def installed(self, name):
+        """
+        :rtype: LocalPackage or None
+        """
+        with self._key_lock(('installed', name)):
+            if name not in self._installed:
+                self._installed[name] = LocalPackage.by_name(name)
+            return self._installed[name]
+
+    def releases(self, name):
+        """
+        Releases of `name` on the repository, newest first.
+
+        :returns: list of (version string, release)
+        """
+        with self._key_lock(('releases', name)):
+            if name not in self._releases:
+                releases = self.repo.releases(name) or []
+                releases = [(str(release['version']), release) for release in releases]
+                releases.sort(key=lambda item: self._version(item[0]), reverse=True)
+                self._releases[name] = releases
+            return self._releases[name]
+
+    def release(self, name, version):
+        for candidate, release in self.releases(name):
+            if candidate == version:
+                return release
+        return None
+
+    def dependencies(self, name, version):
+        """
+        Dependencies of a version of `name`.
+
+        :returns: dict of name -> spec
+        """
+        key = name, version
+        with self._key_lock(('dependencies',) + key):
+            if key in self._dependencies:
+                return self._dependencies[key]
+
+            prev = self.installed(name)
+            release = self.release(name, version)
+            if prev and prev.version == version:
+                deps = prev.manifest().dependencies
+            elif release is None:
+                raise Exception("release not found! (%s==%s)" % (name, version))
+            elif 'dependencies' in release:
+                deps = release['dependencies']
+            else:
+                log.debug('Collecting %s==%s for its dependencies...', name, version)
+                archive = ARCHIVE_STORE.fetch(self.repo, name, version, release.get('sha256'), pin=True)
+                try:
+                    deps = _read_info(archive)[1].get('dependencies', {})
+                finally:
+                    ARCHIVE_STORE.unpin([archive])
+
+            self._dependencies[key] = deps = dict(deps)
+            return deps
+
+    def candidates(self, name, requirements):
+        """
+        Versions of `name` satisfying every requirement, in the order they are tried.
+        Releases are only fetched when the installed version isn't kept.
+        """
+        specs = [spec for spec, _ in requirements]
+
+        prev = self.installed(name)
+        if prev and all(self._match(spec, prev.version) for spec in specs):
+            if not self.allow_upgrade:
+                yield prev.version
+
+        for version, _ in self.releases(name):
+            if prev and not self.allow_upgrade and version == prev.version:
+                continue
+            if all(self._match(spec, version) for spec in specs):
+                yield version
+
+    def _warm(self, name, spec):
+        """
+        Fetches releases and dependencies of the best candidate of `name` ahead of the search,
+        then of its dependencies. Errors are raised again when the search reaches them.
+        """
+        try:
+            for version in self.candidates(name, [(spec, None)]):
+                for dep_name, dep_spec in self.dependencies(name, version).items():
+                    self.warm(dep_name, dep_spec)
+                break
+        except Exception as e:
+            log.debug('Prefetching %s%s failed: %s', name, spec, e)
+
+    def warm(self, name, spec):
+        if self.pool is None:
+            return
+        with self._lock:
+            if (name, spec) in self._warmed:
+                return
+            self._warmed.add((name, spec))
+        self.pool.apply_async(self._warm, (name, spec))
+
+    def resolve(self, name, version_spec='*'):
+        """
+        :returns: dict of name -> version, for `name` and all of its dependencies
+        :raises Exception: when no set of versions satisfies every spec
+        """
+        self._conflicts = []
+        self.warm(name, version_spec)
+
+        requirements = {name: ((version_spec, None),)}
+        result = self._search({}, requirements, [name])
+        if result is None:
+            conflicts = self._conflicts[-MAX_REPORTED_CONFLICTS:]
+            raise Exception("Cannot resolve dependencies of %s%s from %r:\n  %s" % (
+                name, '' if version_spec == '*' else version_spec, self.repo, '\n  '.join(conflicts)))
+
+        decided, self.requirements = result
+        return decided
+
+    def _conflict(self, message):
+        if message not in self._conflicts:
+            self._conflicts.append(message)
+
+    def _search(self, decided, requirements, pending):
+        if not pending:
+            return decided, requirements
+
+        name, rest = pending[0], pending[1:]
+        tried = False
+        for version in self.candidates(name, requirements[name]):
+            tried = True
+            deps = self.dependencies(name, version)
+
+            for dep_name, dep_spec in deps.items():
+                self.warm(dep_name, dep_spec)
+
+            conflict = next((dep_name for dep_name, dep_spec in deps.items()
+                             if dep_name in decided and not self._match(dep_spec, decided[dep_name])), None)
+            if conflict is not None:
+                self._conflict('%s==%s requires %s%s, but %s==%s is selected (%s)' % (
+                    name, version, conflict, deps[conflict], conflict, decided[conflict],
+                    _describe(requirements[conflict])))
+                continue
+
+            next_requirements = dict(requirements)
+            next_pending = list(rest)
+            for dep_name, dep_spec in deps.items():
+                if dep_name == name:
+                    continue
+                next_requirements[dep_name] = requirements.get(dep_name, ()) + ((dep_spec, name),)
+                if dep_name not in decided and dep_name not in next_pending:
+                    next_pending.append(dep_name)
+
+            next_decided = dict(decided)
+            next_decided[name] = version
+            result = self._search(next_decided, next_requirements, next_pending)
+            if result is not None:
+                return result
+
+        if not tried:
+            if not self.releases(name) and not self.installed(name):
+                self._conflict('Release not found on remote repository: %r on %r' % (name, self.repo))
+            else:
+                self._conflict('No release of %s satisfies %s' % (name, _describe(requirements[name])))
+        return None
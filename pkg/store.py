@@ -0,0 +1,201 @@
+"""
+Local store of release archives, shared by every install.
+
+Archives are kept at :code:`g['path']['archives']` by their sha256, and indexed by
+:code:`(repo, name, version)`. When the store grows over :code:`g['archive_store']['max_size']`,
+least recently used archives are removed, except those pinned by an install in progress.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .config import g
+from .downloader import download_file, _hash_file
+from .http_cache import _write_atomic
+from .logger import getLogger
+
+log = getLogger(__name__)
+
+
+class ArchiveStore(object):
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        # digest -> count of pins, see fetch
+        self._pins = {}
+
+    @property
+    def path(self):
+        path = self._path or g['path']['archives']
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    @staticmethod
+    def _key(repo, name, version):
+        return '%s %s %s' % (repo.url, name, version)
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index.json')
+
+    def _archive_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest + '.zip')
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), 'rb') as f:
+                index = json.loads(f.read().decode('utf8'))
+        except (IOError, OSError, ValueError):
+            index = {}
+        index.setdefault('keys', {})
+        index.setdefault('archives', {})
+        return index
+
+    def _save_index(self, index):
+        _write_atomic(self._index_path(), json.dumps(index, indent=1).encode('utf8'))
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _pin(self, digest):
+        self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, paths):
+        """
+        Releases archives pinned by :meth:`fetch`, then evicts archives over the size limit.
+        """
+        with self._lock:
+            for path in paths:
+                digest = self.digest(path)
+                self._pins[digest] -= 1
+                if not self._pins[digest]:
+                    del self._pins[digest]
+
+            index = self._load_index()
+            self._evict(index)
+            self._save_index(index)
+
+    def lookup(self, repo=None, name=None, version=None, sha256=None, pin=False):
+        """
+        Finds a stored archive by its sha256, or by :code:`(repo, name, version)`.
+
+        :param pin: Keeps the archive from eviction, see :meth:`fetch`.
+        :returns: path of the archive, or None
+        """
+        with self._lock:
+            index = self._load_index()
+            if sha256 is None:
+                sha256 = index['keys'].get(self._key(repo, name, version))
+            if sha256 is None or sha256 not in index['archives']:
+                return None
+
+            path = self._archive_path(sha256)
+            if not os.path.isfile(path):
+                del index['archives'][sha256]
+                self._save_index(index)
+                return None
+
+            index['archives'][sha256]['last_used'] = time.time()
+            self._save_index(index)
+            if pin:
+                self._pin(sha256)
+            return path
+
+    def add(self, repo, name, version, path, digest=None, pin=False):
+        """
+        Moves the archive at `path` into the store.
+
+        :param digest: sha256 hex digest of the archive, if already known.
+        :param pin: Keeps the archive from eviction, see :meth:`fetch`.
+        :returns: path of the stored archive
+        """
+        if digest is None:
+            digest = _hash_file(path, hashlib.sha256()).hexdigest()
+        dest = self._archive_path(digest)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+
+        with self._lock:
+            if os.path.isfile(dest):
+                os.unlink(path)
+            else:
+                os.rename(path, dest)
+
+            index = self._load_index()
+            index['keys'][self._key(repo, name, version)] = digest
+            index['archives'][digest] = {'size': os.path.getsize(dest), 'last_used': time.time()}
+            if pin:
+                self._pin(digest)
+            self._evict(index, keep=digest)
+            self._save_index(index)
+
+        return dest
+
+    @staticmethod
+    def digest(path):
+        """
+        sha256 hex digest of a stored archive, from its path.
+        """
+        return os.path.basename(path)[:-len('.zip')]
+
+    def fetch(self, repo, name, version, sha256=None, url=None, pin=False):
+        """
+        Returns a stored archive of the release, downloading it first if it's not stored yet.
+
+        :param sha256: Expected hex digest of the archive, from release metadata.
+          When given, any stored archive with the digest is used, and a download is verified with it.
+        :param url: URL of the archive. Default: :code:`repo.archive_url(name, version)`
+        :param pin: Keeps the archive from eviction until it's passed to :meth:`unpin`, so archives
+          fetched for one install are not evicted by each other.
+        :returns: path of the archive
+        """
+        key = self._key(repo, name, version)
+        with self._key_lock(key):
+            if sha256:
+                path = self.lookup(sha256=sha256.lower(), pin=pin)
+            else:
+                path = self.lookup(repo, name, version, pin=pin)
+            if path:
+                log.debug('Using stored archive of %s==%s: %r', name, version, path)
+                return path
+
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            os.close(fd)
+            try:
+                digest = download_file(url or repo.archive_url(name, version), tmp, segmented=True, sha256=sha256)
+                return self.add(repo, name, version, tmp, digest, pin)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+
+    def _evict(self, index, keep=None):
+        max_size = g['archive_store']['max_size']
+        total = sum(item['size'] for item in index['archives'].values())
+        if total <= max_size:
+            return
+
+        by_age = sorted(index['archives'].items(), key=lambda item: item[1]['last_used'])
+        for digest, item in by_age:
+            if total <= max_size:
+                break
+            if digest == keep or digest in self._pins:
+                continue
+
+            try:
+                os.unlink(self._archive_path(digest))
+            except OSError:
+                # In use (windows), try again later
+                continue
+            total -= item['size']
+            del index['archives'][digest]
+
+        index['keys'] = dict((key, digest) for key, digest in index['keys'].items() if digest in index['archives'])
+
+
+ARCHIVE_STORE = ArchiveStore()
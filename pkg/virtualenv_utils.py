@@ -3,7 +3,6 @@ import runpy
 import subprocess
 import sys
 import tempfile
-from hashlib import sha256
 
 from .logger import getLogger
 from .process import Popen, system
@@ -51,25 +50,22 @@ class FixInterpreter(object):
 
 
 def _install_virtualenv(path):
-    from .downloader import download
-
-    log.info('Downloading virtualenv from %r ...', VIRTUALENV_URL)
-    data = download(VIRTUALENV_URL).read()
-
-    if sha256(data).hexdigest() != HASH:
-        raise RuntimeError('virtualenv hash does not match!')
+    from .downloader import download_file
 
     with tempfile.NamedTemporaryFile('wb', suffix=".zip", delete=False) as zf:
-        zf.write(data)
-        zf.flush()
-        sys.path.insert(0, zf.name)
+        pass
+
+    log.info('Downloading virtualenv from %r ...', VIRTUALENV_URL)
+    # The hash is checked while downloading
+    download_file(VIRTUALENV_URL, zf.name, sha256=HASH)
+    sys.path.insert(0, zf.name)
 
-        import virtualenv
+    import virtualenv
 
-        with FixInterpreter():
-            log.info('Creating environment using virtualenv...')
-            virtualenv.create_environment(path, site_packages=True)
-            log.info('Done!')
+    with FixInterpreter():
+        log.info('Creating environment using virtualenv...')
+        virtualenv.create_environment(path, site_packages=True)
+        log.info('Done!')
 
 
 def prepare_virtualenv(path, tried=False):